@@ -1,143 +1,412 @@
-import gradio as gr
-from pathlib import Path
-import tempfile, subprocess, io, json
-import pandas as pd
-from datetime import date
+import io, json
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
 
 from generate_prescription import (
-    extract_catalog_from_excel,
-    generate_indication_xlsx,
+    extract_catalog,
     human_bucket_choices,
-    compute_bsa_mosteller,
+    preload,
+    build_patient,
+    layout_prescription,
+    ENGINE_PDF,
+    ENGINE_XLSX,
 )
+import metrics
+from pdf_converter import POOL_SIZE, convert_xlsx_bytes, get_pool
+from batch import RosterError, generate_batch, summary_markdown
+from template_registry import TemplateRegistry
+from render_cache import get_render_cache, prescription_key
 
 TITLE = "Generador de Indicaciones Médicas (Quimioterapia)"
 DESC = """
-Sube tu plantilla Excel (con hojas **Indicaciones Médicas** y **Listas**).
+Elige una plantilla registrada o sube tu plantilla Excel (con hojas **Indicaciones Médicas** y **Listas**).
 Captura los datos del paciente, selecciona medicamentos desde los catálogos de **Listas** y genera un PDF imprimible.
 """
 
-def load_catalog(file_obj):
-    if file_obj is None:
-        return gr.update(choices=[]), gr.update(choices=[]), gr.update(choices=[]), gr.update(choices=[])
-    df_cat = extract_catalog_from_excel(file_obj)
+MOTOR_PDF = "PDF directo"
+MOTOR_XLSX = "XLSX + LibreOffice"
+
+# renders simultáneos (uno por instancia de LibreOffice del pool) y máximo de
+# solicitudes esperando en la cola de Gradio antes de rechazar nuevas
+APP_CONCURRENCY = int(os.environ.get("APP_CONCURRENCY", str(POOL_SIZE)))
+APP_QUEUE_MAX = int(os.environ.get("APP_QUEUE_MAX", "64"))
+
+# -------------- Importación barata --------------
+#
+# Los procesos del lote (batch.py, contexto "spawn") vuelven a ejecutar este
+# módulo como __mp_main__. Por eso aquí no se importa gradio, no se abre el
+# registro ni se construye la interfaz: eso ocurre en `build_demo` y en
+# `__main__`, y los workers solo pagan la importación de batch.
+
+@functools.cache
+def _registry() -> TemplateRegistry:
+    return TemplateRegistry()
+
+def _update(**kwargs):
+    import gradio as gr
+    return gr.update(**kwargs)
+
+# -------------- Turnos de render --------------
+#
+# Los manejadores de generación son asíncronos: mientras esperan turno no
+# ocupan un hilo, y el render (bloqueante: fpdf2 o LibreOffice) corre en un
+# executor de APP_CONCURRENCY hilos. Así una ráfaga de solicitudes se encola
+# y cada usuario ve su posición en lugar de agotar el tiempo de espera.
+
+class RenderSlots:
+    """Turnos FIFO para `size` renders simultáneos, con posición de cada solicitud en espera."""
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._active = 0
+        self._waiting: deque[asyncio.Future] = deque()
+
+    async def turn(self):
+        """Espera un turno; mientras espera produce su posición en cola (1 = la siguiente)."""
+        if self._active < self.size and not self._waiting:
+            self._active += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting.append(fut)
+        last = None
+        try:
+            while not fut.done():
+                pos = self._waiting.index(fut) + 1
+                if pos != last:
+                    last = pos
+                    yield pos
+                await asyncio.wait([fut], timeout=0.5)
+        except BaseException:
+            # cancelada (p. ej. el usuario cerró la página): suelta su lugar o su turno
+            if fut in self._waiting:
+                self._waiting.remove(fut)
+            elif fut.done():
+                self.release()
+            raise
+
+    def release(self):
+        # el turno pasa directo a la siguiente solicitud en espera
+        while self._waiting:
+            fut = self._waiting.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._active -= 1
+
+_SLOTS = RenderSlots(APP_CONCURRENCY)
+_EXECUTOR = ThreadPoolExecutor(max_workers=_SLOTS.size, thread_name_prefix="render")
+
+async def _in_executor(fn, *args, spans: list | None = None):
+    # con `spans`, los tramos de metrics que ocurran dentro quedan anotados ahí
+    if spans is not None:
+        fn = functools.partial(metrics.collect, spans, fn)
+    return await asyncio.get_running_loop().run_in_executor(_EXECUTOR, fn, *args)
+
+async def _run_in_turn(fn, *args):
+    """
+    Ejecuta `fn(*args)` en el executor cuando hay turno. Produce
+    ("cola", posición) mientras espera y al final ("listo", resultado).
+    """
+    async for pos in _SLOTS.turn():
+        yield "cola", pos
+    try:
+        result = await _in_executor(fn, *args)
+    finally:
+        _SLOTS.release()
+    yield "listo", result
+
+def _queue_status(pos: int) -> str:
+    return f"⏳ posición en cola: {pos}"
+
+class _Progress:
+    """Etapas de una generación con su duración, para el Markdown de estado."""
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.stages: list[tuple[str, float]] = []
+        self._current: str | None = None
+        self._t = self.t0
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.t0
+
+    def start(self, label: str) -> str:
+        self._current, self._t = label, time.perf_counter()
+        return self.markdown()
+
+    def finish(self):
+        self.stages.append((self._current, time.perf_counter() - self._t))
+        self._current = None
+
+    def markdown(self, title: str | None = None) -> str:
+        lines = [f"- ✔ {label}: {secs:.2f} s" for label, secs in self.stages]
+        if self._current:
+            lines.append(f"- ⏳ {self._current}…")
+        title = title or f"Generando… ({self.elapsed():.1f} s)"
+        return title + "\n\n" + "\n".join(lines)
+
+def _choices_updates(catalog):
+    if catalog is None:
+        return _update(choices=[]), _update(choices=[]), _update(choices=[]), _update(choices=[])
     # choices agrupados
-    prem_choices, ac_choices, qx_choices, otros_choices = human_bucket_choices(df_cat)
+    prem_choices, ac_choices, qx_choices, otros_choices = human_bucket_choices(catalog)
     return (
-        gr.update(choices=prem_choices, value=[]),
-        gr.update(choices=ac_choices,   value=[]),
-        gr.update(choices=qx_choices,   value=[]),
-        gr.update(choices=otros_choices,value=[]),
+        _update(choices=prem_choices, value=[]),
+        _update(choices=ac_choices,   value=[]),
+        _update(choices=qx_choices,   value=[]),
+        _update(choices=otros_choices,value=[]),
     )
 
-def on_generate(
+def _resolve_catalog(plantilla, registrada):
+    # una plantilla registrada (ya en memoria) tiene prioridad sobre la subida
+    if registrada:
+        return _registry().catalog_for_label(registrada)
+    if plantilla is not None:
+        return extract_catalog(plantilla)
+    return None
+
+def load_catalog(file_obj):
+    if file_obj is None:
+        return _choices_updates(None)
+    return _choices_updates(extract_catalog(file_obj))
+
+def load_registered(label):
+    if not label:
+        return _choices_updates(None)
+    return _choices_updates(_registry().catalog_for_label(label))
+
+def on_upload(file_obj):
+    # al subir un archivo se deja de usar la plantilla registrada
+    return (_update(value=None),) + load_catalog(file_obj)
+
+def on_register(plantilla, nombre_plantilla):
+    if plantilla is None:
+        return _update(), "Sube la plantilla a registrar."
+    try:
+        nombre, version = _registry().register(nombre_plantilla or "", plantilla)
+    except ValueError as e:
+        return _update(), str(e)
+    label = f"{nombre} (v{version})"
+    return _update(choices=_registry().labels(), value=label), f"Plantilla registrada: **{label}** ✅"
+
+async def on_generate(
     plantilla, nombre, sexo, dx, objetivo, ciclo,
     peso, talla, cr, alergias, fecha_aplicacion,
-    prem, acs, qx, otros
+    prem, acs, qx, otros, motor=MOTOR_PDF, registrada=None,
+    sc_formula=None, sc_tope=None, edad=None,
 ):
-    if plantilla is None:
-        return None, "Sube una plantilla Excel.", "{}"
+    if plantilla is None and not registrada:
+        yield None, "Elige una plantilla registrada o sube una plantilla Excel.", "{}"
+        return
 
-    with tempfile.TemporaryDirectory() as tmpd:
-        xlsx_in = Path(tmpd) / "plantilla.xlsx"
-        xlsx_in.write_bytes(plantilla.read())
-
-        # catálogo
-        df_cat = extract_catalog_from_excel(xlsx_in.open("rb"))
-        # superficie corporal
-        try:
-            bsa = compute_bsa_mosteller(float(peso), float(talla))
-        except Exception:
-            bsa = None
-
-        patient = {
-            "nombre": nombre.strip(),
-            "sexo": sexo,
-            "diagnostico": dx.strip(),
-            "objetivo": objetivo,
-            "ciclo": int(ciclo) if ciclo is not None else None,
-            "peso": float(peso) if peso not in (None, "") else None,
-            "talla": float(talla) if talla not in (None, "") else None,
-            "cr": float(cr) if cr not in (None, "") else None,
-            "alergias": alergias.strip() if alergias else "",
-            "fecha_aplicacion": fecha_aplicacion.strip() if fecha_aplicacion else "",
-            "bsa": bsa,
-        }
-
-        selections = {
-            "premedicacion": prem or [],
-            "anticuerpos": acs or [],
-            "quimioterapia": qx or [],
-            "otros": otros or [],
-        }
-
-        # crea XLSX con layout imprimible
-        xlsx_out = Path(tmpd) / f"Indicacion_{date.today()}.xlsx"
-        generate_indication_xlsx(
-            plantilla_path=xlsx_in,
-            output_path=xlsx_out,
-            patient=patient,
-            df_catalog=df_cat,
-            selections=selections,
+    try:
+        patient = build_patient(
+            nombre, sexo, dx, objetivo, ciclo,
+            peso, talla, cr, alergias, fecha_aplicacion,
+            sc_formula, sc_tope, edad,
         )
+    except ValueError as e:
+        yield None, f"Datos inválidos: {e}", "{}"
+        return
 
-        # convierte a PDF con LibreOffice
-        pdf_out = Path(tmpd) / f"Indicacion_{date.today()}.pdf"
-        subprocess.run(
-            ["libreoffice", "--headless", "--convert-to", "pdf", "--outdir", str(Path(tmpd)), str(xlsx_out)],
-            check=True
-        )
+    selections = {
+        "premedicacion": prem or [],
+        "anticuerpos": acs or [],
+        "quimioterapia": qx or [],
+        "otros": otros or [],
+    }
 
-        debug_json = json.dumps(
-            {"patient": patient, "selections": selections}, ensure_ascii=False, indent=2
-        )
+    # XLSX + pool de LibreOffice, o maquetación directa del PDF sin subproceso
+    engine = ENGINE_XLSX if motor == MOTOR_XLSX else ENGINE_PDF
+    progreso = _Progress()
+    cache = get_render_cache()
+    spans = []
+    ok = False
+    desde_cache = False
+    try:
+        # fuera de turno: el catálogo suele estar en memoria y un acierto de
+        # la caché de PDFs no necesita maquetar ni convertir
+        yield _update(), progreso.start("Leyendo plantilla"), _update()
+        catalog = await asyncio.to_thread(metrics.collect, spans, _resolve_catalog, plantilla, registrada)
+        key = prescription_key(patient, catalog, selections, engine) if cache is not None else None
+        doc = await asyncio.to_thread(cache.get, key) if key else None
+        progreso.finish()
+        desde_cache = doc is not None
 
-        return pdf_out.read_bytes(), "PDF generado ✅", debug_json
+        if doc is None:
+            t_cola = time.perf_counter()
+            en_cola = False
+            async for pos in _SLOTS.turn():
+                en_cola = True
+                yield _update(), _queue_status(pos), _update()
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - t_cola, stage="cola")
+            if en_cola:
+                progreso.stages.append(("En cola", time.perf_counter() - t_cola))
 
-with gr.Blocks(title=TITLE) as demo:
-    gr.Markdown(f"# {TITLE}\n\n{DESC}")
+            # cada etapa se reporta al empezar; el estado muestra lo que va tardando
+            try:
+                yield _update(), progreso.start("Maquetando"), _update()
+                doc = await _in_executor(layout_prescription, patient, catalog, selections, engine, spans=spans)
+                progreso.finish()
 
-    plantilla = gr.File(label="Plantilla Excel (.xlsx)")
+                if engine == ENGINE_XLSX:
+                    yield _update(), progreso.start("Convirtiendo con LibreOffice"), _update()
+                    doc = await _in_executor(convert_xlsx_bytes, doc, spans=spans)
+                    progreso.finish()
+            finally:
+                _SLOTS.release()
+            if key:
+                await asyncio.to_thread(cache.put, key, doc)
+        ok = True
+    finally:
+        metrics.REQUESTS.inc(kind="individual", engine=engine, result="ok" if ok else "error")
+        metrics.REQUEST_SECONDS.observe(progreso.elapsed(), kind="individual", engine=engine)
 
-    with gr.Row():
-        nombre = gr.Textbox(label="Nombre completo")
-        sexo = gr.Dropdown(choices=["FEM","MAS"], label="Sexo")
-        objetivo = gr.Dropdown(
-            choices=["Adyuvante","Neoadyuvante","Inducción","Mantenimiento","Paliativo","Concomitante","No aplica"],
-            label="Objetivo"
-        )
-        ciclo = gr.Number(label="Ciclo", value=1, precision=0)
-
-    dx = gr.Textbox(label="Diagnóstico")
-    alergias = gr.Textbox(label="Alergias")
-
-    with gr.Row():
-        peso = gr.Number(label="Peso (kg)")
-        talla = gr.Number(label="Talla (cm)")
-        cr = gr.Number(label="Creatinina sérica (mg/dL)")
-        fecha_aplicacion = gr.Textbox(label="Fecha de aplicación (dd.mm.aaaa)")
-
-    gr.Markdown("### Selección de medicamentos (desde **Listas**)")
-    with gr.Row():
-        prem = gr.CheckboxGroup(choices=[], label="Premedicación")
-        acs  = gr.CheckboxGroup(choices=[], label="Anticuerpos monoclonales")
-    with gr.Row():
-        qx   = gr.CheckboxGroup(choices=[], label="Quimioterapia")
-        otros= gr.CheckboxGroup(choices=[], label="Otros")
-
-    # Al subir plantilla, carga catálogos
-    plantilla.change(load_catalog, [plantilla], [prem, acs, qx, otros])
-
-    btn = gr.Button("Generar PDF")
-    archivo = gr.File(label="Descarga el PDF", file_types=[".pdf"])
-    status  = gr.Markdown()
-    debug   = gr.Code(label="(Opcional) Datos enviados", language="json")
-
-    btn.click(
-        on_generate,
-        [plantilla, nombre, sexo, dx, objetivo, ciclo, peso, talla, cr, alergias, fecha_aplicacion, prem, acs, qx, otros],
-        [archivo, status, debug]
+    debug_json = json.dumps(
+        {
+            "patient": patient,
+            "selections": selections,
+            "tiempos_s": {
+                "etapas": {label: round(secs, 4) for label, secs in progreso.stages},
+                "tramos": metrics.summarize(spans),
+            },
+            "desde_cache": desde_cache,
+        },
+        ensure_ascii=False, indent=2,
     )
 
+    origen = "desde caché, " if desde_cache else ""
+    yield doc, progreso.markdown(f"PDF generado ✅ ({origen}{progreso.elapsed():.2f} s)"), debug_json
+
+def _generate_batch(plantilla, registrada, roster, motor):
+    catalog = _resolve_catalog(plantilla, registrada)
+    engine = ENGINE_XLSX if motor == MOTOR_XLSX else ENGINE_PDF
+    return generate_batch(catalog, roster, engine)
+
+async def on_generate_batch(plantilla, roster, motor=MOTOR_PDF, registrada=None):
+    if plantilla is None and not registrada:
+        yield None, "Elige una plantilla registrada o sube una plantilla Excel."
+        return
+    if roster is None:
+        yield None, "Sube un roster de pacientes (CSV o XLSX)."
+        return
+    engine = ENGINE_XLSX if motor == MOTOR_XLSX else ENGINE_PDF
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        async for estado, valor in _run_in_turn(_generate_batch, plantilla, registrada, roster, motor):
+            if estado == "cola":
+                yield _update(), _queue_status(valor)
+            else:
+                zip_bytes, summary = valor
+        ok = True
+    except RosterError as e:
+        yield None, f"No se pudo leer el roster: {e}"
+        return
+    finally:
+        metrics.REQUESTS.inc(kind="lote", engine=engine, result="ok" if ok else "error")
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - t0, kind="lote", engine=engine)
+    yield zip_bytes, summary_markdown(summary)
+
+def build_demo():
+    """Construye la interfaz Gradio (solo en el proceso principal)."""
+    import gradio as gr
+    from bsa import DEFAULT_FORMULA, FORMULAS
+
+    with gr.Blocks(title=TITLE) as demo:
+        gr.Markdown(f"# {TITLE}\n\n{DESC}")
+
+        with gr.Row():
+            registrada = gr.Dropdown(choices=_registry().labels(), value=None, label="Plantilla registrada")
+            plantilla = gr.File(label="Nueva plantilla Excel (.xlsx) o catálogo compilado (.pqcat)")
+        with gr.Row():
+            nombre_plantilla = gr.Textbox(label="Nombre para registrar la plantilla subida")
+            btn_registrar = gr.Button("Registrar plantilla")
+        status_registro = gr.Markdown()
+
+        with gr.Row():
+            nombre = gr.Textbox(label="Nombre completo")
+            sexo = gr.Dropdown(choices=["FEM","MAS"], label="Sexo")
+            objetivo = gr.Dropdown(
+                choices=["Adyuvante","Neoadyuvante","Inducción","Mantenimiento","Paliativo","Concomitante","No aplica"],
+                label="Objetivo"
+            )
+            ciclo = gr.Number(label="Ciclo", value=1, precision=0)
+            edad = gr.Number(label="Edad (años)", precision=0)
+
+        dx = gr.Textbox(label="Diagnóstico")
+        alergias = gr.Textbox(label="Alergias")
+
+        with gr.Row():
+            peso = gr.Number(label="Peso (kg)")
+            talla = gr.Number(label="Talla (cm)")
+            cr = gr.Number(label="Creatinina sérica (mg/dL)")
+            fecha_aplicacion = gr.Textbox(label="Fecha de aplicación (dd.mm.aaaa)")
+        with gr.Row():
+            sc_formula = gr.Dropdown(
+                choices=[(label, key) for key, (label, _) in FORMULAS.items()],
+                value=DEFAULT_FORMULA, label="Fórmula de superficie corporal",
+            )
+            sc_tope = gr.Number(label="Tope de SC (m², opcional)")
+
+        gr.Markdown("### Selección de medicamentos (desde **Listas**)")
+        with gr.Row():
+            prem = gr.CheckboxGroup(choices=[], label="Premedicación")
+            acs  = gr.CheckboxGroup(choices=[], label="Anticuerpos monoclonales")
+        with gr.Row():
+            qx   = gr.CheckboxGroup(choices=[], label="Quimioterapia")
+            otros= gr.CheckboxGroup(choices=[], label="Otros")
+
+        # Al subir plantilla, carga catálogos
+        plantilla.upload(on_upload, [plantilla], [registrada, prem, acs, qx, otros])
+        registrada.change(load_registered, [registrada], [prem, acs, qx, otros])
+        btn_registrar.click(on_register, [plantilla, nombre_plantilla], [registrada, status_registro])
+
+        motor = gr.Radio(choices=[MOTOR_PDF, MOTOR_XLSX], value=MOTOR_PDF, label="Motor de salida")
+        btn = gr.Button("Generar PDF")
+        archivo = gr.File(label="Descarga el PDF", file_types=[".pdf"])
+        status  = gr.Markdown()
+        debug   = gr.Code(label="(Opcional) Datos enviados", language="json")
+
+        btn.click(
+            on_generate,
+            [plantilla, nombre, sexo, dx, objetivo, ciclo, peso, talla, cr, alergias, fecha_aplicacion, prem, acs, qx, otros, motor, registrada, sc_formula, sc_tope, edad],
+            [archivo, status, debug],
+            # la admisión la controla RenderSlots; esperar turno no ocupa un hilo
+            concurrency_limit=None,
+        )
+
+        with gr.Accordion("Generación por lote (roster de pacientes)", open=False):
+            gr.Markdown(
+                "Una fila por paciente con columnas `nombre, sexo, diagnostico, objetivo, ciclo, peso, talla, cr, "
+                "alergias, fecha_aplicacion, premedicacion, anticuerpos, quimioterapia, otros` "
+                "(medicamentos separados por `;`) y, opcionales, `formula_sc`, `tope_sc` y `edad` "
+                "(necesaria para dosis por AUC)."
+            )
+            roster = gr.File(label="Roster de pacientes (.csv / .xlsx)")
+            btn_lote = gr.Button("Generar lote")
+            archivo_lote = gr.File(label="Descarga el ZIP", file_types=[".zip"])
+            status_lote = gr.Markdown()
+
+        btn_lote.click(
+            on_generate_batch, [plantilla, roster, motor, registrada], [archivo_lote, status_lote],
+            concurrency_limit=None,
+        )
+
+    demo.queue(default_concurrency_limit=APP_CONCURRENCY, max_size=APP_QUEUE_MAX)
+    return demo
+
 if __name__ == "__main__":
+    demo = build_demo()
+    get_pool().start()
+    _registry().warm()
+    # métricas en formato Prometheus: http://<host>:METRICS_PORT/metrics
+    metrics.serve()
+    # pandas/openpyxl/xlsxwriter/fpdf2 se cargan mientras la interfaz ya responde
+    threading.Thread(target=preload, daemon=True).start()
     demo.launch()
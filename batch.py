@@ -0,0 +1,311 @@
+from __future__ import annotations
+from collections import deque
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import codecs
+import csv
+import io
+import itertools
+import multiprocessing
+import os
+import re
+import tempfile
+import unicodedata
+import zipfile
+
+from generate_prescription import (
+    BUCKET_KEYS,
+    ENGINE_PDF,
+    ENGINE_XLSX,
+    Catalog,
+    extract_catalog,
+    generate_indication_xlsx,
+    render_prescription_pdf,
+    _BufferReader,
+    _patient_record,
+    _template_buffer,
+)
+from pdf_converter import BATCH_MAX, convert_many
+
+# -------------- Generación por lote desde un roster --------------
+#
+# El roster tiene una fila por paciente. Columnas reconocidas (sin importar
+# mayúsculas ni acentos): nombre, sexo, diagnostico, objetivo, ciclo, peso,
+# talla, cr, alergias, fecha_aplicacion y una columna por bucket
+# (premedicacion, anticuerpos, quimioterapia, otros) con los medicamentos
+# separados por ";". Opcionales: formula_sc (Mosteller, DuBois, Haycock,
+# Boyd), tope_sc (m²) y edad (años; con sexo, peso y cr da la CrCl para
+# las dosis por AUC).
+
+PATIENT_FIELDS = [
+    "nombre", "sexo", "diagnostico", "objetivo", "ciclo",
+    "peso", "talla", "cr", "alergias", "fecha_aplicacion",
+]
+SELECTION_FIELDS = list(BUCKET_KEYS.values())
+SUMMARY_COLS = ["fila", "nombre", "archivo", "estado", "detalle"]
+
+# procesos de render para lotes; 1 = en serie en el proceso actual
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", str(os.cpu_count() or 1)))
+
+
+def _norm_header(h) -> str:
+    txt = unicodedata.normalize("NFKD", str(h or "")).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", "_", txt.strip().lower()).strip("_")
+
+
+def _split_meds(v) -> list[str]:
+    if v is None:
+        return []
+    return [m.strip() for m in str(v).split(";") if m.strip()]
+
+
+class RosterError(ValueError):
+    """El roster no se pudo leer (archivo dañado o formato no reconocido)."""
+
+
+def _decode_csv(data) -> str:
+    # Excel en español exporta "CSV" en cp1252; latin-1 acepta cualquier byte
+    for encoding in ("utf-8-sig", "cp1252"):
+        try:
+            return codecs.decode(data, encoding)
+        except UnicodeDecodeError:
+            pass
+    return codecs.decode(data, "latin-1")
+
+
+def _csv_rows(data) -> list:
+    text = _decode_csv(data)
+    try:
+        dialect = csv.Sniffer().sniff(text.splitlines()[0] if text else ",", delimiters=",;\t")
+    except csv.Error:
+        # p. ej. una sola columna: sin separador que detectar
+        dialect = csv.excel
+    try:
+        return list(csv.reader(io.StringIO(text), dialect))
+    except csv.Error as e:
+        raise RosterError(f"CSV inválido: {e}") from e
+
+
+def read_roster(file_or_path) -> list[dict]:
+    """
+    Lee el roster (CSV o XLSX) y devuelve una lista de
+    {"patient": ..., "selections": ..., "fila": ...} en el orden del archivo
+    ("fila" es el número de fila en el archivo, contando el encabezado). Las filas
+    con datos no numéricos llevan además "error"; un archivo ilegible
+    lanza RosterError.
+    """
+    name = str(getattr(file_or_path, "name", file_or_path)).lower()
+    with _template_buffer(file_or_path) as data:
+        if name.endswith((".xlsx", ".xlsm")):
+            import openpyxl
+
+            try:
+                with _BufferReader(data) as f:
+                    wb = openpyxl.load_workbook(f, read_only=True, data_only=True)
+                    try:
+                        rows = list(wb.worksheets[0].iter_rows(values_only=True))
+                    finally:
+                        wb.close()
+            except Exception as e:  # ZIP dañado, no es un XLSX, sin hojas...
+                raise RosterError(f"XLSX ilegible: {type(e).__name__}: {e}") from e
+        else:
+            rows = _csv_rows(data)
+
+    if not rows:
+        return []
+    header = [_norm_header(h) for h in rows[0]]
+    out, settings = [], []
+    for fila, values in enumerate(rows[1:], start=2):
+        rec = dict(zip(header, values))
+        if all(v in (None, "") for v in rec.values()):
+            continue
+        entry = {"fila": fila, "selections": {k: _split_meds(rec.get(k)) for k in SELECTION_FIELDS}}
+        try:
+            entry["patient"], setting = _patient_record(
+                *(rec.get(f) for f in PATIENT_FIELDS), rec.get("formula_sc"), rec.get("tope_sc"),
+                edad=rec.get("edad"),
+            )
+            settings.append(setting)
+        except (TypeError, ValueError) as e:
+            # la fila se reporta como error en el resumen, sin detener el lote
+            entry["patient"] = {"nombre": str(rec.get("nombre") or "")}
+            entry["error"] = f"Datos inválidos: {e}"
+        out.append(entry)
+    # SC (una pasada por fórmula y tope) y CrCl de todo el roster
+    from dose_engine import derive_patients
+
+    derive_patients([e["patient"] for e in out if "error" not in e], settings)
+    return out
+
+
+def _pdf_name(i: int, patient: dict) -> str:
+    stem = _norm_header(patient.get("nombre")) or "paciente"
+    return f"{i:03d}_{stem}.pdf"
+
+
+def _missing_meds(catalog: Catalog, selections: dict) -> list[str]:
+    missing = []
+    for bucket, key in BUCKET_KEYS.items():
+        missing += [m for m in selections.get(key, []) if catalog.get(bucket, m) is None]
+    return missing
+
+
+# -------------- Render en paralelo --------------
+#
+# Cada proceso recibe el catálogo compilado una sola vez (initializer) y solo
+# los datos del paciente por tarea. Se mantienen como máximo 2 tareas en vuelo
+# por proceso y los resultados se consumen en orden de envío, así el ZIP se
+# escribe en el orden del roster sin acumular todos los PDFs en memoria.
+#
+# Con el motor XLSX los procesos solo maquetan el XLSX; la conversión a PDF
+# se hace en el proceso principal, en grupos de BATCH_MAX archivos por
+# invocación de LibreOffice.
+
+_WORKER_CATALOG: Catalog | None = None
+
+
+def _init_worker(catalog: Catalog):
+    global _WORKER_CATALOG
+    _WORKER_CATALOG = catalog
+
+
+def _render_one(catalog: Catalog, patient: dict, selections: dict, engine: str, xlsx_path: Path | None = None,
+                doses: dict | None = None):
+    try:
+        if xlsx_path is not None:
+            generate_indication_xlsx(None, xlsx_path, patient, catalog, selections, doses=doses)
+            return "ok", xlsx_path
+        return "ok", render_prescription_pdf(patient, catalog, selections, engine, doses)
+    except Exception as e:
+        return "error", f"{type(e).__name__}: {e}"
+
+
+def _render_task(patient: dict, selections: dict, engine: str, xlsx_path: Path | None, doses: dict):
+    return _render_one(_WORKER_CATALOG, patient, selections, engine, xlsx_path, doses)
+
+
+def _collect(fut):
+    if isinstance(fut, tuple):
+        return fut
+    try:
+        return fut.result()
+    except Exception as e:  # proceso caído, error al serializar, etc.
+        return "error", f"{type(e).__name__}: {e}"
+
+
+def render_all(
+    catalog: Catalog,
+    entries: list[dict],
+    engine: str = ENGINE_PDF,
+    workers: int | None = None,
+    xlsx_dir: Path | None = None,
+):
+    """
+    Genera (estado, resultado o mensaje de error) por paciente, en el orden de
+    `entries`. El resultado son los bytes del PDF o, si se pasa `xlsx_dir`, la
+    ruta del XLSX escrito ahí (sin convertir).
+    """
+    def xlsx_path(i):
+        return None if xlsx_dir is None else Path(xlsx_dir) / f"{i:05d}.xlsx"
+
+    from dose_engine import roster_doses
+
+    # dosis de todo el roster en una sola pasada vectorizada
+    doses = roster_doses(catalog, [e["patient"] for e in entries], [e["selections"] for e in entries], BUCKET_KEYS)
+
+    workers = min(workers or BATCH_WORKERS, len(entries))
+    if workers <= 1:
+        for i, e in enumerate(entries):
+            if "error" in e:
+                yield "error", e["error"]
+            else:
+                yield _render_one(catalog, e["patient"], e["selections"], engine, xlsx_path(i), doses[i])
+        return
+
+    max_in_flight = 2 * workers
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(catalog,),
+    ) as ex:
+        pending = deque()
+        for i, e in enumerate(entries):
+            if len(pending) >= max_in_flight:
+                yield _collect(pending.popleft())
+            if "error" in e:
+                pending.append(("error", e["error"]))
+            else:
+                pending.append(ex.submit(_render_task, e["patient"], e["selections"], engine, xlsx_path(i), doses[i]))
+        while pending:
+            yield _collect(pending.popleft())
+
+
+def _convert_grouped(results, outdir: Path):
+    """Convierte los XLSX de `results` en grupos de BATCH_MAX por invocación, conservando el orden."""
+    results = iter(results)
+    while True:
+        group = list(itertools.islice(results, BATCH_MAX))
+        if not group:
+            return
+        xlsx = [payload for estado, payload in group if estado == "ok"]
+        try:
+            pdfs = iter(convert_many(xlsx, outdir) if xlsx else [])
+        except Exception as e:
+            pdfs = iter([e] * len(xlsx))
+        for estado, payload in group:
+            if estado != "ok":
+                yield estado, payload
+                continue
+            pdf = next(pdfs)
+            if isinstance(pdf, Exception):
+                yield "error", f"{type(pdf).__name__}: {pdf}"
+            else:
+                yield "ok", pdf.read_bytes()
+                pdf.unlink()
+
+
+def generate_batch(template, roster, engine: str = ENGINE_PDF, workers: int | None = None) -> tuple[bytes, list[dict]]:
+    """
+    Genera todas las indicaciones del roster contra un único catálogo
+    (`template` puede ser la plantilla o un Catalog ya cargado).
+    Devuelve (ZIP con los PDFs y resumen.csv, filas del resumen).
+    Un error en un paciente queda en el resumen y no detiene el lote.
+    """
+    catalog = template if isinstance(template, Catalog) else extract_catalog(template)
+    entries = read_roster(roster) if not isinstance(roster, list) else roster
+
+    summary = []
+    buf = io.BytesIO()
+    with tempfile.TemporaryDirectory() as tmpd, zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        if engine == ENGINE_XLSX:
+            results = _convert_grouped(render_all(catalog, entries, engine, workers, Path(tmpd)), Path(tmpd))
+        else:
+            results = render_all(catalog, entries, engine, workers)
+        for i, (entry, (estado, payload)) in enumerate(zip(entries, results), start=1):
+            patient = entry["patient"]
+            fname, detalle = "", payload
+            if estado == "ok":
+                fname = _pdf_name(i, patient)
+                zf.writestr(fname, payload)
+                missing = _missing_meds(catalog, entry["selections"])
+                detalle = ("No encontrados en catálogo: " + "; ".join(missing)) if missing else ""
+            summary.append({"fila": entry.get("fila", i), "nombre": patient.get("nombre", ""),
+                            "archivo": fname, "estado": estado, "detalle": detalle})
+
+        report = io.StringIO()
+        writer = csv.DictWriter(report, fieldnames=SUMMARY_COLS)
+        writer.writeheader()
+        writer.writerows(summary)
+        zf.writestr("resumen.csv", report.getvalue().encode("utf-8-sig"))
+
+    return buf.getvalue(), summary
+
+
+def summary_markdown(summary: list[dict]) -> str:
+    ok = sum(1 for s in summary if s["estado"] == "ok")
+    lines = [f"**{ok} de {len(summary)} indicaciones generadas.**"]
+    for s in summary:
+        if s["estado"] != "ok" or s["detalle"]:
+            lines.append(f"- Fila {s['fila']} ({s['nombre'] or 'sin nombre'}): {s['estado']} {s['detalle']}".rstrip())
+    return "\n".join(lines)
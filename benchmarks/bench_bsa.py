@@ -0,0 +1,51 @@
+"""
+Benchmark de superficie corporal sobre un roster sintético.
+
+Compara, por fórmula, el cálculo vectorizado (un solo `compute_bsa` sobre
+arreglos) con un bucle de llamadas escalares, y verifica que ambos den
+exactamente los mismos valores.
+
+    python benchmarks/bench_bsa.py [--patients 100000] [--cap 2.0]
+"""
+from __future__ import annotations
+from pathlib import Path
+import argparse
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bsa import FORMULAS, compute_bsa  # noqa: E402
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--patients", type=int, default=100_000)
+    ap.add_argument("--cap", type=float, default=None, help="tope de SC (m²)")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    peso = rng.uniform(35, 140, args.patients).round(1)
+    talla = rng.uniform(140, 200, args.patients).round(1)
+    peso_l, talla_l = peso.tolist(), talla.tolist()
+
+    print(f"{args.patients} pacientes" + (f", tope {args.cap:g} m²" if args.cap else ""))
+    print(f"{'fórmula':<11}{'vector ms':>11}{'escalar ms':>12}{'x':>8}{'media m²':>10}  iguales")
+    for key, (label, _) in FORMULAS.items():
+        t0 = time.perf_counter()
+        vec = compute_bsa(peso, talla, key, args.cap)
+        t_vec = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        esc = [compute_bsa(p, t, key, args.cap) for p, t in zip(peso_l, talla_l)]
+        t_esc = time.perf_counter() - t0
+
+        same = np.array_equal(vec, np.asarray(esc, dtype=np.float64))
+        print(f"{label:<11}{t_vec*1e3:>11.2f}{t_esc*1e3:>12.1f}{t_esc/t_vec:>8.0f}{vec.mean():>10.3f}  {'sí' if same else 'NO'}")
+
+
+if __name__ == "__main__":
+    main()
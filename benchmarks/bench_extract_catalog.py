@@ -0,0 +1,88 @@
+"""
+Benchmark del descubrimiento de tablas en "Listas".
+
+Compara el lector original (read_excel + barrido celda a celda limitado a
+200x40) con el lector en streaming actual, sobre plantillas sintéticas de
+miles de filas. "filas orig." / "filas stream" son las filas de catálogo que
+encuentra cada uno: el original pierde las tablas que empiezan después de la
+fila 200.
+
+    python benchmarks/bench_extract_catalog.py
+"""
+from __future__ import annotations
+from pathlib import Path
+import io
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from generate_prescription import _parse_catalog  # noqa: E402
+from synthetic import write_listas_workbook  # noqa: E402
+
+
+def legacy_parse_catalog(data: bytes) -> pd.DataFrame:
+    """Implementación original (read_excel + bucle Python con iat/iloc)."""
+    raw = pd.read_excel(io.BytesIO(data), sheet_name="Listas", header=None)
+
+    def infer_bucket(r, c):
+        for up in range(max(0, r-8), r)[::-1]:
+            txt = " ".join(str(v).lower() for v in raw.iloc[up, max(0,c-2):c+1].tolist())
+            for key, name in (("premedic", "Premedicación"), ("anticuerp", "Anticuerpos"),
+                              ("quimiot", "Quimioterapia"), ("otros", "Otros")):
+                if key in txt:
+                    return name
+        return "Catálogo"
+
+    cat_frames = []
+    for r in range(min(200, raw.shape[0])):
+        for c in range(min(40, raw.shape[1]-1)):
+            if str(raw.iat[r, c]).strip().lower() == "medicamento":
+                header = raw.iloc[r, c:c+6].tolist()
+                if "Medicamento" not in header[0]:
+                    continue
+                rows = []
+                rr = r + 1
+                while rr < raw.shape[0]:
+                    row = raw.iloc[rr, c:c+6]
+                    if row.isna().all():
+                        break
+                    rows.append(row.tolist())
+                    rr += 1
+                df = pd.DataFrame(rows, columns=["Medicamento","Dosis","Solución","VS","Tiempo","Via"])
+                df["bucket"] = infer_bucket(r, c)
+                df = df[~df["Medicamento"].astype(str).str.strip().isin(["-", "nan", "None"])]
+                cat_frames.append(df)
+    cat = pd.concat(cat_frames, ignore_index=True)
+    cat = cat.drop_duplicates(subset=["bucket","Medicamento"], keep="first")
+    return cat[["bucket","Medicamento","Dosis","Solución","VS","Tiempo","Via"]]
+
+
+def best_of(fn, arg, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    print(f"{'filas/tabla':>12} {'tablas/bucket':>14} {'original ms':>12} {'streaming ms':>13} "
+          f"{'x':>6} {'filas orig.':>12} {'filas stream':>13}")
+    for rows, tables in ((100, 1), (1_000, 1), (5_000, 1), (100, 4), (1_000, 4)):
+        buf = io.BytesIO()
+        write_listas_workbook(buf, rows, tables)
+        data = buf.getvalue()
+        old, new = legacy_parse_catalog(data), _parse_catalog(data)
+        repeat = 3 if rows * tables <= 1_000 else 1
+        t_old = best_of(legacy_parse_catalog, data, repeat)
+        t_new = best_of(_parse_catalog, data, repeat)
+        print(f"{rows:>12} {tables:>14} {t_old*1e3:>12.1f} {t_new*1e3:>13.1f} "
+              f"{t_old/t_new:>6.1f} {len(old):>12} {len(new):>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Suite de benchmarks por etapa sobre plantillas y pacientes sintéticos.
+
+Etapas medidas por caso (tamaño de plantilla x disposición de buckets):
+    parse        _parse_catalog (lectura de "Listas")
+    catalog      construcción del Catalog a partir de los registros
+    choices      human_bucket_choices
+    xlsx_layout  generate_indication_xlsx en memoria, por paciente
+    pdf_layout   generate_indication_pdf en memoria, por paciente
+    conversion   convert_xlsx_bytes con LibreOffice, por paciente (--convert)
+
+Los resultados se escriben en JSON y se pueden comparar con una línea base:
+
+    python benchmarks/bench_suite.py -o resultados.json
+    python benchmarks/bench_suite.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_suite.py --baseline benchmarks/baseline.json --threshold 1.25
+
+Con --baseline, termina con código 1 si alguna etapa es más lenta que la
+línea base por encima del umbral (mediana contra mediana).
+"""
+from __future__ import annotations
+from datetime import datetime, timezone
+from pathlib import Path
+import argparse
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from generate_prescription import (  # noqa: E402
+    Catalog,
+    _parse_catalog,
+    generate_indication_pdf,
+    generate_indication_xlsx,
+    human_bucket_choices,
+)
+from synthetic import LAYOUTS, patient_workload, write_listas_workbook  # noqa: E402
+
+# nombre -> (filas por tabla, tablas por bucket)
+SIZES = {
+    "chica": (20, 1),
+    "mediana": (200, 2),
+    "grande": (1_000, 4),
+}
+
+
+def _timed(fn, *args) -> float:
+    t0 = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - t0) * 1e3
+
+
+def _stats(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))]
+    # 6 decimales (ns): las etapas rápidas no quedan en 0 en la línea base
+    return {
+        "n": len(samples),
+        "min_ms": round(samples[0], 6),
+        "median_ms": round(statistics.median(samples), 6),
+        "p95_ms": round(p95, 6),
+    }
+
+
+def _render_xlsx(patient, catalog, selections):
+    generate_indication_xlsx(None, io.BytesIO(), patient, catalog, selections)
+
+
+def _render_pdf(patient, catalog, selections):
+    generate_indication_pdf(io.BytesIO(), patient, catalog, selections)
+
+
+def run_case(size: str, layout: str, repeat: int, patients: int, convert: bool) -> dict:
+    rows, tables = SIZES[size]
+    buf = io.BytesIO()
+    write_listas_workbook(buf, rows, tables, layout=layout)
+    data = buf.getvalue()
+
+    stages: dict[str, list[float]] = {"parse": [], "catalog": [], "choices": []}
+    records = _parse_catalog(data)  # calentamiento (importación diferida de openpyxl)
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        records = _parse_catalog(data)
+        stages["parse"].append((time.perf_counter() - t0) * 1e3)
+    catalog = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        catalog = Catalog(records)
+        stages["catalog"].append((time.perf_counter() - t0) * 1e3)
+    choices = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        choices = human_bucket_choices(catalog)
+        stages["choices"].append((time.perf_counter() - t0) * 1e3)
+
+    workload = list(patient_workload(choices, patients))
+    # un render de calentamiento (importaciones diferidas, fuentes)
+    p0, s0 = workload[0]
+    _render_xlsx(p0, catalog, s0)
+    _render_pdf(p0, catalog, s0)
+    stages["xlsx_layout"] = [_timed(_render_xlsx, p, catalog, s) for p, s in workload]
+    stages["pdf_layout"] = [_timed(_render_pdf, p, catalog, s) for p, s in workload]
+
+    if convert:
+        from pdf_converter import convert_xlsx_bytes, get_pool
+
+        get_pool().start()
+        docs = []
+        for p, s in workload:
+            out = io.BytesIO()
+            generate_indication_xlsx(None, out, p, catalog, s)
+            docs.append(out.getvalue())
+        convert_xlsx_bytes(docs[0])  # calentamiento
+        stages["conversion"] = [_timed(convert_xlsx_bytes, d) for d in docs]
+
+    return {
+        "case": f"{size}/{layout}",
+        "filas_catalogo": len(catalog),
+        "stages": {name: _stats(samples) for name, samples in stages.items()},
+    }
+
+
+def _git_rev() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Imprime la comparación y devuelve las etapas que empeoraron más que `threshold`."""
+    base = {c["case"]: c["stages"] for c in baseline["results"]}
+    regressions = []
+    print(f"\n{'caso':<18}{'etapa':<13}{'base ms':>10}{'actual ms':>11}{'x':>7}")
+    for case in results["results"]:
+        for stage, st in case["stages"].items():
+            ref = base.get(case["case"], {}).get(stage)
+            if ref is None:
+                continue
+            if not ref["median_ms"]:
+                # línea base redondeada a 0 (guardada con 3 decimales): no hay razón que calcular
+                print(f"{case['case']:<18}{stage:<13}{'0':>10}{st['median_ms']:>11.2f}{'-':>7}  (sin base)")
+                continue
+            ratio = st["median_ms"] / ref["median_ms"]
+            flag = "  <-- más lento" if ratio > threshold else ""
+            print(f"{case['case']:<18}{stage:<13}{ref['median_ms']:>10.2f}{st['median_ms']:>11.2f}{ratio:>7.2f}{flag}")
+            if flag:
+                regressions.append(f"{case['case']}:{stage}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmarks por etapa con plantillas y pacientes sintéticos.")
+    ap.add_argument("--sizes", default=",".join(SIZES), help=f"tamaños ({', '.join(SIZES)})")
+    ap.add_argument("--layouts", default=",".join(LAYOUTS), help=f"disposición de buckets ({', '.join(LAYOUTS)})")
+    ap.add_argument("--repeat", type=int, default=5, help="repeticiones de parse/catalog/choices")
+    ap.add_argument("--patients", type=int, default=20, help="pacientes por caso para la maquetación")
+    ap.add_argument("--convert", action="store_true", help="incluye la conversión con LibreOffice")
+    ap.add_argument("-o", "--output", help="escribe los resultados en este JSON")
+    ap.add_argument("--save-baseline", help="guarda los resultados como línea base")
+    ap.add_argument("--baseline", help="compara contra esta línea base")
+    ap.add_argument("--threshold", type=float, default=1.25, help="razón actual/base que cuenta como regresión")
+    args = ap.parse_args(argv)
+
+    results = {
+        "meta": {
+            "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git": _git_rev(),
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "repeat": args.repeat,
+            "patients": args.patients,
+        },
+        "results": [],
+    }
+    print(f"{'caso':<18}{'filas':>7}  " + "  ".join(f"{s:>11}" for s in
+          ("parse", "catalog", "choices", "xlsx_layout", "pdf_layout", "conversion")))
+    for size in args.sizes.split(","):
+        for layout in args.layouts.split(","):
+            case = run_case(size, layout, args.repeat, args.patients, args.convert)
+            results["results"].append(case)
+            cells = [case["stages"].get(s, {}).get("median_ms") for s in
+                     ("parse", "catalog", "choices", "xlsx_layout", "pdf_layout", "conversion")]
+            print(f"{case['case']:<18}{case['filas_catalogo']:>7}  " +
+                  "  ".join(f"{c:>11.2f}" if c is not None else f"{'-':>11}" for c in cells))
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    for path in (args.output, args.save_baseline):
+        if path:
+            Path(path).write_text(text, encoding="utf-8")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nregresiones (> x{args.threshold}): {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
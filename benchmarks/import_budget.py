@@ -0,0 +1,66 @@
+"""
+Presupuesto de tiempo de importación.
+
+Importa cada módulo en un intérprete nuevo (varias veces, se toma el mejor
+tiempo) y falla si supera el presupuesto o si al importarlo se cargan
+dependencias pesadas que deberían esperar al primer uso.
+
+    python benchmarks/import_budget.py [--budget-ms 150] [--runs 5]
+
+Presupuesto por defecto: IMPORT_BUDGET_MS (150 ms).
+"""
+from __future__ import annotations
+from pathlib import Path
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+MODULES = ["generate_prescription", "batch", "template_registry", "app"]
+HEAVY = ["pandas", "numpy", "openpyxl", "xlsxwriter", "fpdf", "gradio"]
+
+_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import {module}
+ms = (time.perf_counter() - t) * 1000
+print(json.dumps({{"ms": ms, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module: str, runs: int) -> tuple[float, list[str]]:
+    best, heavy = float("inf"), []
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY)],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        res = json.loads(out)
+        best = min(best, res["ms"])
+        heavy = res["heavy"]
+    return best, heavy
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--budget-ms", type=float, default=float(os.environ.get("IMPORT_BUDGET_MS", "150")))
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("modules", nargs="*", default=MODULES)
+    args = ap.parse_args(argv)
+
+    failed = False
+    print(f"{'módulo':<24}{'ms':>8}  pesados cargados")
+    for module in args.modules:
+        ms, heavy = measure(module, args.runs)
+        bad = ms > args.budget_ms or bool(heavy)
+        failed |= bad
+        print(f"{module:<24}{ms:>8.1f}  {', '.join(heavy) or '-'}{'  <-- FUERA DE PRESUPUESTO' if bad else ''}")
+    print(f"presupuesto: {args.budget_ms:.0f} ms")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
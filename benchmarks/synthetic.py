@@ -0,0 +1,88 @@
+"""
+Hojas "Listas" sintéticas y cargas de pacientes para benchmarks.
+
+Con `layout="columnas"` cada bucket ocupa un bloque de 6 columnas (más una de
+separación) con su título arriba y `tables_per_bucket` apila varias tablas
+por bucket hacia abajo. Con `layout="apilado"` todas las tablas van en las
+mismas 6 columnas, una debajo de otra.
+"""
+from __future__ import annotations
+import random
+
+import xlsxwriter
+
+BUCKET_TITLES = ["Premedicación", "Anticuerpos monoclonales", "Quimioterapia", "Otros"]
+HEADER = ["Medicamento", "Dosis", "Solución", "VS", "Tiempo", "Via"]
+DOSES = ["8 mg", "375 mg/m²", "75 mg/m²", "AUC 5", "1.5 mg/kg", "100 mg", "-"]
+
+
+LAYOUTS = ("columnas", "apilado")
+
+
+def listas_cells(rows_per_table: int, tables_per_bucket: int = 1, seed: int = 0, layout: str = "columnas"):
+    """Genera (fila, columna, valor) de una hoja Listas sintética."""
+    if layout not in LAYOUTS:
+        raise ValueError(f"layout desconocido: {layout}")
+    rnd = random.Random(seed)
+    row = 0
+    for b, title in enumerate(BUCKET_TITLES):
+        col = b * 7 if layout == "columnas" else 0
+        if layout == "columnas":
+            row = 0
+        for t in range(tables_per_bucket):
+            yield row, col, title
+            for j, h in enumerate(HEADER):
+                yield row + 2, col + j, h
+            for i in range(rows_per_table):
+                r = row + 3 + i
+                yield r, col, f"{title[:5]} {t}-{i}"
+                yield r, col + 1, rnd.choice(DOSES)
+                yield r, col + 2, rnd.choice(["SSN 0.9%", "SG 5%"])
+                yield r, col + 3, rnd.choice([100, 250, 500])
+                yield r, col + 4, rnd.choice(["15 min", "30 min", "1 h"])
+                yield r, col + 5, rnd.choice(["IV", "VO", "SC"])
+            row += rows_per_table + 5
+
+
+def write_listas_workbook(target, rows_per_table: int, tables_per_bucket: int = 1, seed: int = 0,
+                          layout: str = "columnas"):
+    """Escribe una plantilla con hojas "Indicaciones Médicas" y "Listas" en `target` (ruta o buffer)."""
+    wb = xlsxwriter.Workbook(target, {"in_memory": True} if hasattr(target, "write") else {})
+    wb.add_worksheet("Indicaciones Médicas")
+    ws = wb.add_worksheet("Listas")
+    for r, c, v in listas_cells(rows_per_table, tables_per_bucket, seed, layout):
+        ws.write(r, c, v)
+    wb.close()
+
+
+def patient_workload(choices, n: int, meds_per_bucket: int = 3, seed: int = 0):
+    """
+    `n` pacientes sintéticos como (datos del paciente, selecciones).
+    `choices` son las listas por bucket de `human_bucket_choices`.
+    """
+    rnd = random.Random(seed)
+    keys = ("premedicacion", "anticuerpos", "quimioterapia", "otros")
+    for i in range(n):
+        peso = round(rnd.uniform(45, 110), 1)
+        talla = round(rnd.uniform(145, 195), 1)
+        patient = {
+            "nombre": f"Paciente {i:05d}",
+            "sexo": rnd.choice(["FEM", "MAS"]),
+            "diagnostico": rnd.choice(["Ca mama", "Linfoma", "Ca colon", "Ca pulmón"]),
+            "objetivo": rnd.choice(["Adyuvante", "Paliativo", "Neoadyuvante"]),
+            "ciclo": rnd.randint(1, 8),
+            "peso": peso,
+            "talla": talla,
+            "cr": round(rnd.uniform(0.5, 1.6), 2),
+            "alergias": rnd.choice(["Negadas", "Penicilina", ""]),
+            "fecha_aplicacion": f"{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}.2025",
+            "bsa": round(((peso * talla) / 3600) ** 0.5, 2),
+            "edad": rnd.randint(25, 85),
+        }
+        # CrCl (Cockcroft-Gault) como la deja dose_engine.derive_patients
+        female = 0.85 if patient["sexo"] == "FEM" else 1.0
+        patient["crcl"] = round((140 - patient["edad"]) * peso / (72 * patient["cr"]) * female, 1)
+        selections = {
+            k: rnd.sample(list(c), min(meds_per_bucket, len(c))) for k, c in zip(keys, choices)
+        }
+        yield patient, selections
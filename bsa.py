@@ -0,0 +1,93 @@
+"""
+Superficie corporal (SC, m²) con varias fórmulas y tope opcional.
+
+Peso en kg y talla en cm. Todas las funciones aceptan escalares o arreglos
+de NumPy (p. ej. un roster completo) con el mismo código, así un paciente
+suelto y el mismo paciente dentro de un lote dan exactamente el mismo valor.
+Datos faltantes o no positivos dan NaN (None para escalares en `compute_bsa`).
+
+    Mosteller   sqrt(peso x talla / 3600)
+    DuBois      0.007184 x peso^0.425 x talla^0.725
+    Haycock     0.024265 x peso^0.5378 x talla^0.3964
+    Boyd        0.0003207 x talla^0.3 x peso_g^(0.7285 - 0.0188 x log10(peso_g))
+"""
+from __future__ import annotations
+import math
+
+import numpy as np
+
+
+def mosteller(peso, talla):
+    return np.sqrt(peso * talla / 3600.0)
+
+
+def dubois(peso, talla):
+    return 0.007184 * np.power(peso, 0.425) * np.power(talla, 0.725)
+
+
+def haycock(peso, talla):
+    return 0.024265 * np.power(peso, 0.5378) * np.power(talla, 0.3964)
+
+
+def boyd(peso, talla):
+    gramos = peso * 1000.0
+    return 0.0003207 * np.power(talla, 0.3) * np.power(gramos, 0.7285 - 0.0188 * np.log10(gramos))
+
+
+# clave -> (nombre para mostrar, función)
+FORMULAS = {
+    "mosteller": ("Mosteller", mosteller),
+    "dubois": ("DuBois", dubois),
+    "haycock": ("Haycock", haycock),
+    "boyd": ("Boyd", boyd),
+}
+DEFAULT_FORMULA = "mosteller"
+
+
+def formula_key(name) -> str:
+    """Clave de fórmula a partir de la clave o del nombre ("DuBois", "du bois"...)."""
+    key = "".join(str(name or DEFAULT_FORMULA).lower().split())
+    if key not in FORMULAS:
+        raise ValueError(f"Fórmula de SC desconocida: {name} (opciones: {', '.join(v[0] for v in FORMULAS.values())})")
+    return key
+
+
+def check_cap(cap: float | None) -> float | None:
+    """Valida el tope de SC: None (sin tope) o un número positivo."""
+    if cap is not None and not cap > 0:
+        raise ValueError(f"Tope de SC inválido: {cap:g} (debe ser mayor que 0)")
+    return cap
+
+
+def bsa_array(peso, talla, formula: str = DEFAULT_FORMULA, cap: float | None = None) -> np.ndarray:
+    """SC vectorizada; `peso`, `talla` (y el resultado) son arreglos float64, NaN si falta el dato."""
+    peso = np.asarray(peso, dtype=np.float64)
+    talla = np.asarray(talla, dtype=np.float64)
+    fn = FORMULAS[formula_key(formula)][1]
+    cap = check_cap(cap)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        valid = (peso > 0) & (talla > 0)
+        out = np.where(valid, fn(np.where(valid, peso, 1.0), np.where(valid, talla, 1.0)), np.nan)
+        if cap is not None:
+            # tope de SC (p. ej. 2.0 m²): np.fmin conserva los NaN del dato faltante
+            out = np.where(np.isnan(out), np.nan, np.fmin(out, cap))
+    return out
+
+
+def compute_bsa(peso, talla, formula: str = DEFAULT_FORMULA, cap: float | None = None):
+    """
+    SC con la fórmula elegida y tope opcional. Con escalares devuelve float
+    (o None si falta peso/talla); con arreglos, un arreglo.
+    """
+    if np.ndim(peso) == 0 and np.ndim(talla) == 0:
+        if peso is None or talla is None:
+            return None
+        v = float(bsa_array(peso, talla, formula, cap))
+        return None if math.isnan(v) else v
+    return bsa_array(peso, talla, formula, cap)
+
+
+def describe(formula: str = DEFAULT_FORMULA, cap: float | None = None) -> str:
+    """Texto para la indicación: "DuBois" o "DuBois (tope 2 m²)"."""
+    label = FORMULAS[formula_key(formula)][0]
+    return f"{label} (tope {cap:g} m²)" if cap is not None else label
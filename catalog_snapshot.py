@@ -0,0 +1,165 @@
+"""
+Formato binario de catálogo precompilado (".pqcat").
+
+Pensado para leerse directamente desde un mmap, sin parsear el XLSX:
+
+    cabecera   <8s H H 32s 32s I I I>
+               magia, versión, reservado, SHA-256 de la plantilla,
+               huella de formato, n.º de registros, n.º de buckets,
+               tamaño de la tabla de textos
+    buckets    n_buckets x <I I I I>  (offset y largo del nombre,
+               primer registro, n.º de registros)
+    registros  n_registros x 6 x <I I B>  (offset, largo y tipo de
+               Medicamento, Dosis, Solución, VS, Tiempo, Via)
+    textos     UTF-8 concatenado
+
+Los registros están agrupados por bucket, así que cada bucket es un rango
+contiguo y de tamaño fijo dentro del archivo.
+
+    python catalog_snapshot.py plantilla.xlsx [-o plantilla.xlsx.pqcat]
+"""
+from __future__ import annotations
+from typing import NamedTuple
+import struct
+
+MAGIC = b"PQCAT\x00\x00\x01"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sHH32s32sIII")
+_BUCKET = struct.Struct("<IIII")
+_FIELD = struct.Struct("<IIB")
+_N_FIELDS = 6
+_RECORD_SIZE = _FIELD.size * _N_FIELDS
+
+# tipo de cada valor
+_EMPTY, _STR, _INT, _FLOAT = 0, 1, 2, 3
+
+
+class StaleSnapshotError(ValueError):
+    """El snapshot no corresponde a la plantilla o al formato actual."""
+
+
+class Snapshot(NamedTuple):
+    source_digest: str
+    layout: bytes
+    records: list[tuple]
+
+
+def is_snapshot(buf) -> bool:
+    return len(buf) >= len(MAGIC) and bytes(buf[:len(MAGIC)]) == MAGIC
+
+
+class _Strings:
+    def __init__(self):
+        self.blob = bytearray()
+        self._seen: dict[bytes, int] = {}
+
+    def add(self, text: str) -> tuple[int, int]:
+        raw = text.encode("utf-8")
+        off = self._seen.get(raw)
+        if off is None:
+            off = self._seen[raw] = len(self.blob)
+            self.blob += raw
+        return off, len(raw)
+
+
+def _encode(v, strings: _Strings) -> bytes:
+    if v is None or v == "":
+        return _FIELD.pack(0, 0, _EMPTY)
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        kind, text = _STR, str(v)
+    elif isinstance(v, int):
+        kind, text = _INT, str(v)
+    else:
+        kind, text = _FLOAT, repr(v)
+    return _FIELD.pack(*strings.add(text), kind)
+
+
+def dump_snapshot(records, source_digest: str, layout: bytes) -> bytes:
+    """
+    Serializa registros (bucket, Medicamento, Dosis, Solución, VS, Tiempo, Via).
+    `source_digest` es el SHA-256 (hex) de la plantilla de origen.
+    """
+    strings = _Strings()
+    by_bucket: dict[str, list[tuple]] = {}
+    for rec in records:
+        by_bucket.setdefault(rec[0], []).append(rec[1:])
+
+    bucket_table = bytearray()
+    record_table = bytearray()
+    n_records = 0
+    for bucket, rows in by_bucket.items():
+        bucket_table += _BUCKET.pack(*strings.add(bucket), n_records, len(rows))
+        for row in rows:
+            for v in row:
+                record_table += _encode(v, strings)
+        n_records += len(rows)
+
+    header = _HEADER.pack(
+        MAGIC, VERSION, 0, bytes.fromhex(source_digest), layout,
+        n_records, len(by_bucket), len(strings.blob),
+    )
+    return bytes(header + bucket_table + record_table + strings.blob)
+
+
+def _check_header(buf):
+    if len(buf) < _HEADER.size or not is_snapshot(buf):
+        raise StaleSnapshotError("No es un snapshot de catálogo.")
+    header = _HEADER.unpack_from(buf, 0)
+    if header[1] != VERSION:
+        raise StaleSnapshotError(f"Versión de snapshot {header[1]} no soportada (se espera {VERSION}).")
+    return header
+
+
+def peek_source_digest(buf) -> str:
+    """SHA-256 de la plantilla de origen, leyendo solo la cabecera."""
+    return _check_header(buf)[3].hex()
+
+
+def parse_snapshot(buf) -> Snapshot:
+    """Lee un snapshot desde cualquier buffer (bytes, memoryview sobre mmap...)."""
+    _, _, _, digest, layout, n_records, n_buckets, n_strings = _check_header(buf)
+    buckets_at = _HEADER.size
+    records_at = buckets_at + n_buckets * _BUCKET.size
+    strings_at = records_at + n_records * _RECORD_SIZE
+    if len(buf) < strings_at + n_strings:
+        raise StaleSnapshotError("Snapshot truncado.")
+    text = bytes(buf[strings_at:strings_at + n_strings])
+
+    def value(off, length, kind):
+        if kind == _EMPTY:
+            return ""
+        s = text[off:off + length].decode("utf-8")
+        if kind == _INT:
+            return int(s)
+        if kind == _FLOAT:
+            return float(s)
+        return s
+
+    records = []
+    for b in range(n_buckets):
+        name_off, name_len, first, count = _BUCKET.unpack_from(buf, buckets_at + b * _BUCKET.size)
+        bucket = text[name_off:name_off + name_len].decode("utf-8")
+        for i in range(first, first + count):
+            base = records_at + i * _RECORD_SIZE
+            records.append((bucket,) + tuple(
+                value(*_FIELD.unpack_from(buf, base + j * _FIELD.size)) for j in range(_N_FIELDS)
+            ))
+    return Snapshot(digest.hex(), layout, records)
+
+
+def main(argv=None):
+    import argparse
+    from generate_prescription import compile_template
+
+    ap = argparse.ArgumentParser(description="Compila una plantilla XLSX a snapshot de catálogo (.pqcat).")
+    ap.add_argument("plantilla")
+    ap.add_argument("-o", "--output", help="destino (por defecto <plantilla>.pqcat)")
+    args = ap.parse_args(argv)
+    out = args.output or args.plantilla + ".pqcat"
+    blob = compile_template(args.plantilla, out)
+    print(f"{out}: {len(blob)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Motor de dosis: interpreta la columna "Dosis" del catálogo y calcula la
+dosis absoluta (mg) de cada medicamento seleccionado.
+
+Unidades reconocidas (el texto completo de la celda debe ser "<número> <unidad>"):
+    mg, g, mcg/µg       dosis fija            -> mg
+    mg/m², mg/m2        por superficie (SC)   -> mg = dosis x SC
+    mg/kg               por peso              -> mg = dosis x peso
+    AUC <n>             carboplatino          -> mg = AUC x (TFG + 25)  (Calvert)
+
+La TFG de Calvert es la CrCl de Cockcroft-Gault con tope (renal.py), salvo
+que el paciente traiga una TFG medida ("tfg"). La CrCl se calcula una sola
+vez para todo el roster (`derive_patients`) y queda en el paciente ("crcl"),
+igual que la SC ("bsa").
+Cualquier otro texto ("8-16 mg", "según peso", vacío) queda sin calcular.
+Las dosis del catálogo se interpretan una sola vez (`Catalog.doses`) y el
+cálculo se hace con NumPy para una indicación o para un roster completo.
+Cada dosis va con su "base del cálculo" ("375 mg/m² x SC 1.63 m²") para la
+tabla de la indicación.
+"""
+from __future__ import annotations
+from collections import defaultdict
+from decimal import ROUND_HALF_UP, Decimal
+from typing import NamedTuple
+import math
+import re
+
+import numpy as np
+
+import bsa
+import renal
+
+UNIT_UNKNOWN, UNIT_MG, UNIT_MG_M2, UNIT_MG_KG, UNIT_AUC = range(5)
+
+UNIT_LABELS = {UNIT_MG: "mg", UNIT_MG_M2: "mg/m²", UNIT_MG_KG: "mg/kg", UNIT_AUC: "AUC"}
+
+_NUM = r"(\d+(?:[.,]\d+)?)"
+_MASS = {"mg": 1.0, "g": 1000.0, "mcg": 0.001, "µg": 0.001, "μg": 0.001, "ug": 0.001}
+_DOSE_RE = re.compile(
+    rf"^{_NUM}\s*(mg|g|mcg|µg|μg|ug)\s*(?:/\s*(m2|m²|kg))?$", re.IGNORECASE,
+)
+_AUC_RE = re.compile(rf"^auc\s*=?\s*{_NUM}$", re.IGNORECASE)
+
+
+def parse_dose(value) -> tuple[float, int]:
+    """(cantidad, unidad) de una celda de dosis; (nan, UNIT_UNKNOWN) si no se reconoce."""
+    if value is None or isinstance(value, (int, float)):
+        # un número suelto no dice si es mg o mg/m²
+        return math.nan, UNIT_UNKNOWN
+    text = " ".join(str(value).split())
+    m = _AUC_RE.match(text)
+    if m:
+        return float(m.group(1).replace(",", ".")), UNIT_AUC
+    m = _DOSE_RE.match(text)
+    if not m:
+        return math.nan, UNIT_UNKNOWN
+    amount = float(m.group(1).replace(",", ".")) * _MASS[m.group(2).lower()]
+    per = (m.group(3) or "").lower()
+    if per == "kg":
+        return amount, UNIT_MG_KG
+    if per in ("m2", "m²"):
+        return amount, UNIT_MG_M2
+    return amount, UNIT_MG
+
+
+def dose_settings() -> dict:
+    """Configuración (por entorno) que cambia las dosis impresas; forma parte de la clave de render_cache."""
+    return {"calvert_gfr_cap": renal.CALVERT_GFR_CAP}
+
+
+class CatalogDoses(NamedTuple):
+    """Dosis interpretadas del catálogo: posición por (bucket, medicamento) y arreglos paralelos."""
+    index: dict[tuple[str, str], int]
+    amount: np.ndarray   # float64
+    unit: np.ndarray     # int8 (UNIT_*)
+
+
+def parse_catalog_doses(catalog) -> CatalogDoses:
+    index = {}
+    amounts, units = [], []
+    for key, entry in catalog.by_key.items():
+        amount, unit = parse_dose(entry.dosis)
+        index[key] = len(amounts)
+        amounts.append(amount)
+        units.append(unit)
+    return CatalogDoses(index, np.asarray(amounts, dtype=np.float64), np.asarray(units, dtype=np.int8))
+
+
+def compute_doses(doses: CatalogDoses, entry: np.ndarray, patient: np.ndarray,
+                  bsa: np.ndarray, peso: np.ndarray, gfr: np.ndarray | None = None) -> np.ndarray:
+    """
+    Dosis en mg para cada par (entrada del catálogo, paciente), en una sola
+    pasada. `entry` y `patient` son índices paralelos; `bsa`, `peso` y `gfr`
+    tienen un valor por paciente (NaN si falta). Sin dato -> NaN.
+    """
+    amount = doses.amount[entry]
+    unit = doses.unit[entry]
+    with np.errstate(invalid="ignore"):
+        mg = np.full(amount.shape, np.nan)
+        mg = np.where(unit == UNIT_MG, amount, mg)
+        mg = np.where(unit == UNIT_MG_M2, amount * bsa[patient], mg)
+        mg = np.where(unit == UNIT_MG_KG, amount * peso[patient], mg)
+        if gfr is not None:
+            mg = np.where(unit == UNIT_AUC, renal.calvert_dose(amount, gfr[patient]), mg)
+    return mg
+
+
+class Dose(NamedTuple):
+    """Dosis calculada de un medicamento: mg (None si falta un dato) y base del cálculo."""
+    mg: float | None
+    base: str
+
+
+def _column(patients: list[dict], key: str) -> np.ndarray:
+    return np.array([np.nan if p.get(key) is None else p[key] for p in patients], dtype=np.float64)
+
+
+def derive_patients(patients: list[dict], bsa_settings: list[tuple[str, float | None]]) -> list[dict]:
+    """
+    Completa (en el mismo dict) la SC ("bsa", m²) con la (fórmula, tope) de
+    `bsa_settings` de cada paciente y la CrCl de Cockcroft-Gault ("crcl",
+    mL/min) de todos los pacientes: un `bsa_array` por cada (fórmula, tope)
+    distinta y una sola pasada de CrCl. None si falta algún dato.
+    """
+    peso, talla = _column(patients, "peso"), _column(patients, "talla")
+    groups = defaultdict(list)
+    for i, setting in enumerate(bsa_settings):
+        groups[setting].append(i)
+    sc = np.full(len(patients), np.nan)
+    for (formula, cap), idx in groups.items():
+        sc[idx] = bsa.bsa_array(peso[idx], talla[idx], formula, cap)
+    female = [renal.female_flag(p.get("sexo")) for p in patients]
+    crcl = renal.cockcroft_gault(_column(patients, "edad"), peso, _column(patients, "cr"), female)
+    for p, s, c in zip(patients, sc.tolist(), crcl.tolist()):
+        p["bsa"] = None if math.isnan(s) else s
+        p["crcl"] = None if math.isnan(c) else round(c, 1)
+    return patients
+
+
+def _patient_arrays(patients: list[dict]):
+    """SC, peso y TFG de Calvert por paciente (NaN si falta)."""
+    # una TFG medida tiene prioridad sobre la estimada
+    crcl, tfg = _column(patients, "crcl"), _column(patients, "tfg")
+    gfr = renal.calvert_gfr(np.where(np.isnan(tfg), crcl, tfg))
+    return _column(patients, "bsa"), _column(patients, "peso"), gfr
+
+
+def _base(unit: int, amount: float, bsa: float, peso: float, gfr: float) -> str:
+    if unit == UNIT_MG:
+        return "dosis fija"
+    if unit == UNIT_MG_M2:
+        return "falta SC" if math.isnan(bsa) else f"{amount:g} mg/m² x SC {bsa:.2f} m²"
+    if unit == UNIT_MG_KG:
+        return "falta peso" if math.isnan(peso) else f"{amount:g} mg/kg x {peso:g} kg"
+    if unit == UNIT_AUC:
+        if math.isnan(gfr):
+            return "falta TFG (edad, sexo, peso, Cr)"
+        tope = " (tope)" if gfr == renal.CALVERT_GFR_CAP else ""
+        return f"Calvert: AUC {amount:g} x (TFG {gfr:.1f}{tope} + 25)"
+    return ""
+
+
+def roster_doses(catalog, patients: list[dict], selections: list[dict], bucket_keys: dict[str, str]) -> list[dict]:
+    """
+    Dosis calculadas de todo un roster en una pasada vectorizada (incluidas
+    CrCl y Calvert). Devuelve, por paciente, {(bucket, medicamento): Dose}.
+    """
+    doses = catalog.doses
+    pairs_entry, pairs_patient, keys = [], [], []
+    for i, sel in enumerate(selections):
+        if not isinstance(sel, dict):
+            continue
+        for bucket, sel_key in bucket_keys.items():
+            for med in sel.get(sel_key, []):
+                j = doses.index.get((bucket, str(med)))
+                if j is not None:
+                    pairs_entry.append(j)
+                    pairs_patient.append(i)
+                    keys.append((bucket, str(med)))
+
+    out = [{} for _ in patients]
+    if not keys:
+        return out
+    bsa, peso, gfr = _patient_arrays(patients)
+    entry = np.asarray(pairs_entry, dtype=np.intp)
+    patient = np.asarray(pairs_patient, dtype=np.intp)
+    mg = compute_doses(doses, entry, patient, bsa, peso, gfr)
+    rows = zip(
+        pairs_patient, keys, mg.tolist(), doses.unit[entry].tolist(), doses.amount[entry].tolist(),
+        bsa[patient].tolist(), peso[patient].tolist(), gfr[patient].tolist(),
+    )
+    for i, key, v, unit, amount, b, w, g in rows:
+        out[i][key] = Dose(None if math.isnan(v) else v, _base(unit, amount, b, w, g))
+    return out
+
+
+def prescription_doses(catalog, patient: dict, selections: dict, bucket_keys: dict[str, str]) -> dict:
+    """Dosis calculadas de una sola indicación (ver `roster_doses`)."""
+    return roster_doses(catalog, [patient], [selections], bucket_keys)[0]
+
+
+def format_mg(mg: float | None):
+    """
+    Valor para la columna de dosis calculada, "" si no se pudo calcular.
+    Desde 10 mg se redondea a décimas; por debajo, a 3 cifras significativas
+    (0.025 mg, 2.75 mg), para que una dosis pequeña nunca se imprima como 0.
+    Redondeo comercial (la mitad hacia arriba), no el de `round`.
+    """
+    if mg is None:
+        return ""
+    d = Decimal(repr(mg))
+    if d == 0:
+        return 0
+    step = Decimal("0.1") if abs(d) >= 10 else Decimal(1).scaleb(d.adjusted() - 2)
+    mg = float(d.quantize(step, rounding=ROUND_HALF_UP))
+    return int(mg) if mg.is_integer() else mg
@@ -1,75 +1,454 @@
 from __future__ import annotations
 from pathlib import Path
+from collections import OrderedDict, deque
+import atexit
+import contextlib
+import hashlib
 import io
 import math
-import pandas as pd
-import openpyxl
-from openpyxl.utils import get_column_letter
-import xlsxwriter
+import mmap
+import os
+import queue
+import re
+import stat
+import tempfile
+import threading
+import unicodedata
+from typing import TYPE_CHECKING
+
+import catalog_snapshot
+import metrics
+from pdf_converter import convert_xlsx_bytes
+
+# pandas, openpyxl, xlsxwriter y fpdf2 se importan en el primer uso: el
+# arranque de la app (y de cada proceso del lote) no paga por ellos.
+if TYPE_CHECKING:
+    import pandas as pd
+    from fpdf import FPDF
 
 # -------------- Utilidades --------------
 
 def compute_bsa_mosteller(peso_kg: float, talla_cm: float) -> float:
-    """BSA (m²) = sqrt( (peso * talla) / 3600 )"""
-    return ((peso_kg * talla_cm) / 3600.0) ** 0.5
+    """BSA (m²) = sqrt( (peso * talla) / 3600 ); ver bsa.py para las demás fórmulas."""
+    import bsa
+    return bsa.compute_bsa(peso_kg, talla_cm, "mosteller")
+
+def _num(v, cast=float):
+    if v is None or (isinstance(v, str) and not v.strip()):
+        return None
+    if isinstance(v, float) and math.isnan(v):
+        return None
+    if isinstance(v, str):
+        txt = v.strip()
+        # coma decimal (CSV de Excel en español: "70,5"); "1.234,5" es ambiguo y se rechaza
+        if "," in txt and "." not in txt:
+            txt = txt.replace(",", ".")
+        try:
+            v = float(txt)
+        except ValueError:
+            raise ValueError(f"número inválido: {v!r}") from None
+    return cast(float(v))
+
+def _text(v) -> str:
+    if v is None or (isinstance(v, float) and math.isnan(v)):
+        return ""
+    return str(v).strip()
+
+def build_patient(
+    nombre, sexo, diagnostico, objetivo, ciclo,
+    peso, talla, cr, alergias, fecha_aplicacion,
+    bsa_formula=None, bsa_cap=None, edad=None,
+) -> dict:
+    """
+    Normaliza los datos capturados (UI o roster) al dict `patient` que usan
+    los generadores. La SC se calcula con `bsa_formula` (Mosteller por
+    defecto) y, si se indica, se limita a `bsa_cap` m². Con edad, sexo,
+    peso y Cr se estima la CrCl (Cockcroft-Gault) para dosis por AUC.
+    """
+    from dose_engine import derive_patients
+
+    patient, setting = _patient_record(
+        nombre, sexo, diagnostico, objetivo, ciclo, peso, talla, cr, alergias, fecha_aplicacion,
+        bsa_formula, bsa_cap, edad,
+    )
+    return derive_patients([patient], [setting])[0]
+
+def _patient_record(
+    nombre, sexo, diagnostico, objetivo, ciclo,
+    peso, talla, cr, alergias, fecha_aplicacion,
+    bsa_formula=None, bsa_cap=None, edad=None,
+) -> tuple[dict, tuple[str, float | None]]:
+    # `build_patient` sin SC ni CrCl, más la (fórmula, tope) de SC; el roster
+    # las completa de una vez con `derive_patients`
+    import bsa
+
+    peso, talla, cr, edad = _num(peso), _num(talla), _num(cr), _num(edad, int)
+    formula, cap = bsa.formula_key(_text(bsa_formula) or None), bsa.check_cap(_num(bsa_cap))
+    patient = {
+        "nombre": _text(nombre),
+        "sexo": _text(sexo) or None,
+        "edad": edad,
+        "diagnostico": _text(diagnostico),
+        "objetivo": _text(objetivo) or None,
+        "ciclo": _num(ciclo, int),
+        "peso": peso,
+        "talla": talla,
+        "cr": cr,
+        "alergias": _text(alergias),
+        "fecha_aplicacion": _text(fecha_aplicacion),
+        # superficie corporal
+        "bsa": None,
+        "bsa_formula": bsa.describe(formula, cap),
+    }
+    return patient, (formula, cap)
+
+def _disk_path(src) -> Path | None:
+    if isinstance(src, (str, os.PathLike)):
+        return Path(src)
+    # objetos de subida (tempfile de Gradio, archivos abiertos) con ruta en disco
+    name = getattr(src, "name", None)
+    if isinstance(name, (str, os.PathLike)) and os.path.isfile(name):
+        return Path(name)
+    return None
+
+_UID = os.getuid() if hasattr(os, "getuid") else None
+
+def user_cache_dir(name: str) -> str:
+    """Directorio por usuario en el temporal del sistema: <tmp>/<name>-<uid>."""
+    return os.path.join(tempfile.gettempdir(), name if _UID is None else f"{name}-{_UID}")
+
+def private_dir(root: Path) -> Path:
+    """Crea `root` con modo 0700 o comprueba que el existente sea un directorio propio y privado."""
+    root.mkdir(mode=0o700, parents=True, exist_ok=True)
+    st = os.lstat(root)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f"{root} no es un directorio")
+    if _UID is not None:
+        # otro usuario pudo crearlo antes (p. ej. en /tmp) para plantar o leer archivos
+        if st.st_uid != _UID:
+            raise PermissionError(f"{root} pertenece a otro usuario (uid {st.st_uid})")
+        if st.st_mode & 0o077:
+            os.chmod(root, 0o700)
+    return root
+
+@contextlib.contextmanager
+def _template_buffer(src):
+    """
+    Contenido de la plantilla como memoryview de solo lectura, sin copiarlo:
+    los archivos en disco se mapean en memoria y bytes/BytesIO se exponen
+    tal cual. La vista solo es válida dentro del bloque `with`.
+    """
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        yield memoryview(src)
+        return
+    if isinstance(src, io.BytesIO):
+        with src.getbuffer() as view:
+            yield view
+        return
+    path = _disk_path(src)
+    if path is None:
+        # stream sin archivo detrás: una única lectura
+        if hasattr(src, "seek"):
+            src.seek(0)
+        yield memoryview(src.read())
+        return
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b"")
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            yield view
+
+class _BufferReader(io.RawIOBase):
+    """Archivo de solo lectura sobre un buffer (para openpyxl/zipfile) sin copiarlo entero."""
 
-def _read_excel_bytes(file_or_path) -> bytes:
-    if hasattr(file_or_path, "read"):
-        return file_or_path.read()
-    p = Path(file_or_path)
-    return p.read_bytes()
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view = memoryview(b"")
+        super().close()
 
 # -------------- Catálogo desde "Listas" --------------
 
+CATALOG_COLS = ["Medicamento","Dosis","Solución","VS","Tiempo","Via"]
+
+class CatalogEntry:
+    """Una fila del catálogo (un medicamento dentro de un bucket)."""
+    __slots__ = ("bucket", "medicamento", "dosis", "solucion", "vs", "tiempo", "via")
+
+    def __init__(self, bucket, medicamento, dosis, solucion, vs, tiempo, via):
+        self.bucket = bucket
+        self.medicamento = medicamento
+        self.dosis = _blank_nan(dosis)
+        self.solucion = _blank_nan(solucion)
+        self.vs = _blank_nan(vs)
+        self.tiempo = _blank_nan(tiempo)
+        self.via = _blank_nan(via)
+
+    def row(self, med=None) -> list:
+        """Valores en el orden de TABLE_COLS."""
+        return [self.medicamento if med is None else med,
+                self.dosis, self.solucion, self.vs, self.tiempo, self.via]
+
+def spanish_sort_key(text) -> tuple[str, str]:
+    """
+    Clave de orden alfabético en español: sin distinguir mayúsculas ni
+    acentos ("Ácido" junto a "acetato") y con la "ñ" después de la "n".
+    No depende del locale instalado en el sistema.
+    """
+    s = unicodedata.normalize("NFC", str(text)).casefold().replace("ñ", "n\uffff")
+    base = "".join(c for c in unicodedata.normalize("NFD", s) if not unicodedata.combining(c))
+    # desempate estable entre variantes que solo difieren en acentos/mayúsculas
+    return base, str(text)
+
+class Catalog:
+    """
+    Catálogo compilado una sola vez: índice (bucket, medicamento) -> CatalogEntry
+    y lista de entradas por bucket. Las búsquedas cuestan O(1) por medicamento.
+    `digest` es el SHA-256 de la plantilla de origen (si se conoce).
+
+    `choices` guarda, por bucket, los nombres ya ordenados (`spanish_sort_key`)
+    para la interfaz.
+
+    No depende de pandas; `frame` es solo una vista para exportar o inspeccionar.
+    """
+    __slots__ = ("by_key", "by_bucket", "choices", "digest", "_frame", "_doses")
+
+    def __init__(self, records, digest: str | None = None):
+        self.by_key: dict[tuple[str, str], CatalogEntry] = {}
+        self.by_bucket: dict[str, list[CatalogEntry]] = {}
+        self.digest = digest
+        self._frame = None
+        self._doses = None
+        for rec in records:
+            e = CatalogEntry(*rec)
+            key = (e.bucket, str(e.medicamento))
+            if key in self.by_key:
+                continue
+            self.by_key[key] = e
+            self.by_bucket.setdefault(e.bucket, []).append(e)
+        # by_key ya deduplica por (bucket, nombre)
+        self.choices: dict[str, tuple[str, ...]] = {
+            bucket: tuple(sorted((str(e.medicamento) for e in entries), key=spanish_sort_key))
+            for bucket, entries in self.by_bucket.items()
+        }
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame, digest: str | None = None) -> "Catalog":
+        cat = cls(frame[["bucket"] + CATALOG_COLS].itertuples(index=False, name=None), digest)
+        cat._frame = frame
+        return cat
+
+    @property
+    def frame(self) -> pd.DataFrame:
+        if self._frame is None:
+            import pandas as pd
+            self._frame = pd.DataFrame(list(self.records()), columns=["bucket"] + CATALOG_COLS)
+        return self._frame
+
+    @property
+    def doses(self):
+        """Dosis del catálogo ya interpretadas (ver dose_engine), una sola vez por catálogo."""
+        if self._doses is None:
+            import dose_engine
+            self._doses = dose_engine.parse_catalog_doses(self)
+        return self._doses
+
+    def records(self):
+        """Tuplas (bucket, Medicamento, Dosis, Solución, VS, Tiempo, Via), agrupadas por bucket."""
+        for entries in self.by_bucket.values():
+            for e in entries:
+                yield (e.bucket, e.medicamento, e.dosis, e.solucion, e.vs, e.tiempo, e.via)
+
+    def get(self, bucket: str, medicamento) -> CatalogEntry | None:
+        return self.by_key.get((bucket, str(medicamento)))
+
+    def entries(self, bucket: str) -> list[CatalogEntry]:
+        return self.by_bucket.get(bucket, [])
+
+    def __len__(self):
+        return len(self.by_key)
+
+def _as_catalog(df_catalog) -> Catalog:
+    return df_catalog if isinstance(df_catalog, Catalog) else Catalog.from_frame(df_catalog)
+
+# caché de catálogos por SHA-256 de la plantilla, compartida por todo el proceso
+CATALOG_CACHE_SIZE = int(os.environ.get("CATALOG_CACHE_SIZE", "16"))
+_CATALOG_CACHE: OrderedDict[str, Catalog] = OrderedDict()
+_CATALOG_CACHE_LOCK = threading.Lock()
+
+def template_digest(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def extract_catalog(xlsx_file) -> Catalog:
+    """
+    Lee la hoja 'Listas' y devuelve el catálogo compilado (ver `Catalog`).
+    También acepta un snapshot ya compilado (ver `compile_template`).
+
+    El resultado se cachea (LRU) por el hash del contenido: la misma
+    plantilla no se vuelve a parsear. El catálogo devuelto es compartido,
+    no debe modificarse.
+    """
+    with _template_buffer(xlsx_file) as data:
+        key = template_digest(data)
+        with _CATALOG_CACHE_LOCK:
+            cat = _CATALOG_CACHE.get(key)
+            if cat is not None:
+                _CATALOG_CACHE.move_to_end(key)
+                metrics.CATALOG_CACHE.inc(result="hit")
+                return cat
+        metrics.CATALOG_CACHE.inc(result="miss")
+        if catalog_snapshot.is_snapshot(data):
+            with metrics.span("catalog_snapshot"):
+                cat = _catalog_from_snapshot(data)
+        else:
+            with metrics.span("catalog_parse"):
+                cat = Catalog(_parse_catalog(data), key)
+    with _CATALOG_CACHE_LOCK:
+        _CATALOG_CACHE[key] = cat
+        while len(_CATALOG_CACHE) > CATALOG_CACHE_SIZE:
+            _CATALOG_CACHE.popitem(last=False)
+    return cat
+
+def _catalog_from_snapshot(data) -> Catalog:
+    snap = catalog_snapshot.parse_snapshot(data)
+    if snap.layout != LAYOUT_FINGERPRINT:
+        raise catalog_snapshot.StaleSnapshotError("El snapshot se compiló con otro formato de catálogo; vuelve a compilarlo.")
+    return Catalog(snap.records, snap.source_digest)
+
+def compile_template(xlsx_file, output_path=None) -> bytes:
+    """
+    Compila la plantilla a un snapshot binario (registros del catálogo,
+    índice por bucket, hash de la plantilla y huella de formato).
+    Si se indica `output_path`, además lo escribe ahí.
+    """
+    catalog = extract_catalog(xlsx_file)
+    blob = catalog_snapshot.dump_snapshot(catalog.records(), catalog.digest, LAYOUT_FINGERPRINT)
+    if output_path is not None:
+        Path(output_path).write_bytes(blob)
+    return blob
+
+def load_compiled_template(xlsx_path, snapshot_path=None) -> Catalog:
+    """
+    Catálogo de una plantilla en disco usando su snapshot (por defecto
+    `<plantilla>.pqcat`). Si el snapshot no existe, es de otro formato o la
+    plantilla cambió (otro SHA-256), se recompila y se reescribe.
+    """
+    xlsx_path = Path(xlsx_path)
+    snapshot_path = Path(snapshot_path) if snapshot_path else xlsx_path.with_name(xlsx_path.name + ".pqcat")
+    with _template_buffer(xlsx_path) as data:
+        digest = template_digest(data)
+    if snapshot_path.exists():
+        try:
+            with _template_buffer(snapshot_path) as snap:
+                if catalog_snapshot.peek_source_digest(snap) == digest:
+                    return extract_catalog(snap)
+        except catalog_snapshot.StaleSnapshotError:
+            pass
+    compile_template(xlsx_path, snapshot_path)
+    return extract_catalog(xlsx_path)
+
 def extract_catalog_from_excel(xlsx_file) -> pd.DataFrame:
     """
     Lee la hoja 'Listas' y devuelve un DataFrame de catálogo:
     columnas: bucket, Medicamento, Dosis, Solución, VS, Tiempo, Via
+    (solo para exportar/inspeccionar; la generación usa `extract_catalog`).
+    """
+    return extract_catalog(xlsx_file).frame
+
+def _parse_catalog(data) -> list[tuple]:
+    """
+    Registros (bucket, Medicamento, Dosis, Solución, VS, Tiempo, Via) de la
+    hoja 'Listas', en orden de aparición y sin duplicados por (bucket, Medicamento).
+    """
+    import openpyxl
+
+    with _BufferReader(memoryview(data)) as f:
+        wb = openpyxl.load_workbook(f, read_only=True, data_only=True)
+        try:
+            tables = list(_iter_listas_tables(wb["Listas"].iter_rows(values_only=True)))
+        finally:
+            wb.close()
+
+    records = []
+    seen = set()
+    for bucket, rows in tables:
+        for row in rows:
+            med = row[0]
+            # limpia filas vacías o separadores "-"
+            if str(med).strip() in ("-", "nan", "None"):
+                continue
+            # quita duplicados conservando la primera entrada (suele haber listas repetidas)
+            key = (bucket, str(med))
+            if key in seen:
+                continue
+            seen.add(key)
+            records.append((bucket, *row))
+    return records
+
+def _iter_listas_tables(rows):
+    """
+    Recorre la hoja fila a fila y devuelve (bucket, filas) por cada tabla
+    encabezada por una celda "Medicamento", en el orden de sus encabezados.
+
+    Solo se retienen las últimas filas (para deducir el bucket) y las
+    tablas abiertas: la memoria depende del tamaño de las tablas, no de la hoja.
     """
-    raw = pd.read_excel(io.BytesIO(_read_excel_bytes(xlsx_file)), sheet_name="Listas", header=None)
-    cat_frames = []
-
-    # Estrategia robusta: busca filas que contengan "Medicamento" en alguna columna
-    # y asume que las 5-6 columnas siguientes contienen la tabla.
-    for r in range(min(200, raw.shape[0])):
-        for c in range(min(40, raw.shape[1]-1)):
-            if str(raw.iat[r, c]).strip().lower() == "medicamento":
-                # intenta leer 6 columnas: Medicamento, Dosis, Solución, VS, Tiempo, Via
-                header = raw.iloc[r, c:c+6].tolist()
-                if "Medicamento" not in header[0]:
-                    continue
-                # consume hacia abajo hasta que toda la fila sean NaN
-                rows = []
-                rr = r + 1
-                while rr < raw.shape[0]:
-                    row = raw.iloc[rr, c:c+6]
-                    if row.isna().all():
-                        break
-                    rows.append(row.tolist())
-                    rr += 1
-                df = pd.DataFrame(rows, columns=["Medicamento","Dosis","Solución","VS","Tiempo","Via"])
+    width = len(CATALOG_COLS)
+    recent = deque(maxlen=8)
+    open_tables = []   # [orden, columna, bucket, filas]
+    done = []
+
+    for row in rows:
+        # una tabla termina en la primera fila con sus 6 columnas vacías
+        still_open = []
+        for tbl in open_tables:
+            c = tbl[1]
+            cells = list(row[c:c+width])
+            cells += [None] * (width - len(cells))
+            if all(v is None for v in cells):
+                done.append(tbl)
+            else:
+                tbl[3].append(cells)
+                still_open.append(tbl)
+        open_tables = still_open
+
+        for c, v in enumerate(row):
+            if isinstance(v, str) and "Medicamento" in v and v.strip().lower() == "medicamento":
                 # intenta deducir bucket mirando títulos cercanos (en columnas previas)
-                bucket = _infer_bucket(raw, r, c)
-                df["bucket"] = bucket
-                # limpia filas vacías o separadores "-"
-                df = df[~df["Medicamento"].astype(str).str.strip().isin(["-", "nan", "None"])]
-                cat_frames.append(df)
-
-    if not cat_frames:
-        return pd.DataFrame(columns=["bucket","Medicamento","Dosis","Solución","VS","Tiempo","Via"])
-
-    cat = pd.concat(cat_frames, ignore_index=True)
-    # normaliza bucket
-    cat["bucket"] = cat["bucket"].fillna("Desconocido")
-    # quita duplicados conservando la primera entrada (suele haber listas repetidas)
-    cat = cat.drop_duplicates(subset=["bucket","Medicamento"], keep="first")
-    return cat[["bucket","Medicamento","Dosis","Solución","VS","Tiempo","Via"]]
-
-def _infer_bucket(raw: pd.DataFrame, r: int, c: int) -> str:
-    # explora hacia arriba en mismas columnas buscando títulos típicos
-    for up in range(max(0, r-8), r)[::-1]:
-        row_vals = raw.iloc[up, max(0,c-2):c+1].astype(str).str.lower().tolist()
-        txt = " ".join(row_vals)
+                open_tables.append([len(done) + len(open_tables), c, _infer_bucket(recent, c), []])
+        recent.append(row)
+
+    done.extend(open_tables)
+    for _, _, bucket, table_rows in sorted(done, key=lambda t: t[0]):
+        yield bucket, table_rows
+
+def _infer_bucket(recent, c: int) -> str:
+    # explora hacia arriba (hasta 8 filas) en mismas columnas buscando títulos típicos
+    for row in reversed(recent):
+        txt = " ".join(str(v).lower() for v in row[max(0,c-2):c+1])
         if "premedic" in txt:
             return "Premedicación"
         if "anticuerp" in txt:
@@ -80,9 +459,11 @@ def _infer_bucket(raw: pd.DataFrame, r: int, c: int) -> str:
             return "Otros"
     return "Catálogo"
 
-def human_bucket_choices(df_cat: pd.DataFrame):
+def human_bucket_choices(df_cat: Catalog | pd.DataFrame):
+    catalog = _as_catalog(df_cat)
     def choices(bucket):
-        return sorted(df_cat[df_cat["bucket"]==bucket]["Medicamento"].astype(str).tolist())
+        # listas precalculadas al compilar el catálogo; copia para la interfaz
+        return list(catalog.choices.get(bucket, ()))
     prem = choices("Premedicación")
     acs  = choices("Anticuerpos")
     qx   = choices("Quimioterapia")
@@ -94,13 +475,16 @@ def human_bucket_choices(df_cat: pd.DataFrame):
 HEADER_MAP = [
     ("Nombre:",               "nombre"),
     ("Sexo:",                 "sexo"),
+    ("Edad (años):",          "edad"),
     ("Diagnóstico:",          "diagnostico"),
     ("Objetivo:",             "objetivo"),
     ("Ciclo:",                "ciclo"),
     ("Peso (Kg):",            "peso"),
     ("Talla (cm):",           "talla"),
     ("Cr:",                   "cr"),
+    ("CrCl C-G (mL/min):",    "crcl"),
     ("SC (m²):",              "bsa"),
+    ("Fórmula SC:",           "bsa_formula"),
     ("Alergias:",             "alergias"),
     ("Fecha aplicación:",     "fecha_aplicacion"),
 ]
@@ -112,80 +496,415 @@ TABLE_ORDER = [
     ("O T R O S", "Otros"),
 ]
 
-TABLE_COLS = ["Medicamento","Dosis (mg o mg/m²)","Solución","Volumen","Tiempo","Vía"]
+TABLE_COLS = ["Medicamento","Dosis (mg o mg/m²)","Solución","Volumen","Tiempo","Vía","Dosis calculada (mg)","Base del cálculo"]
+
+# clave del dict `selections` para cada bucket del catálogo
+BUCKET_KEYS = {
+    "Premedicación": "premedicacion",
+    "Anticuerpos":   "anticuerpos",
+    "Quimioterapia": "quimioterapia",
+    "Otros":         "otros",
+}
+
+# huella de columnas y buckets del catálogo: invalida snapshots compilados
+# con otro formato (ver catalog_snapshot.py)
+LAYOUT_FINGERPRINT = hashlib.sha256(repr((CATALOG_COLS, list(BUCKET_KEYS))).encode()).digest()
+
+def prescription_doses(catalog: Catalog, patient: dict, selections: dict) -> dict:
+    """Dosis calculadas (`dose_engine.Dose`) de los medicamentos seleccionados, por (bucket, medicamento)."""
+    import dose_engine
+    return dose_engine.prescription_doses(catalog, patient, selections, BUCKET_KEYS)
+
+def _selected_rows(catalog: Catalog, selections: dict, bucket: str, doses: dict | None = None):
+    """
+    Filas (en el orden de TABLE_COLS) de los medicamentos seleccionados en un
+    bucket; las dos últimas columnas son la dosis calculada de `doses` y su base.
+    """
+    if not isinstance(selections, dict):
+        return []
+    from dose_engine import format_mg
+
+    doses = doses or {}
+    meds = selections.get(BUCKET_KEYS.get(bucket, bucket.lower()), [])
+    out = []
+    for med in meds:
+        e = catalog.get(bucket, med)
+        if e is not None:
+            d = doses.get((bucket, str(med)))
+            out.append(e.row(med) + ([format_mg(d.mg), d.base] if d else ["", ""]))
+    return out
+
+def _blank_nan(v):
+    # celdas vacías de Excel llegan como NaN; xlsxwriter no las acepta
+    if v is None or (isinstance(v, float) and math.isnan(v)):
+        return ""
+    return v
+
+# -------------- Plan de maquetación del XLSX --------------
+#
+# Lo que no depende del paciente se compila una sola vez: propiedades de los
+# formatos, anchos de columna y las celdas estáticas (título, etiquetas del
+# encabezado, títulos y encabezados de tabla) con su posición. Cada
+# indicación solo agrega sus valores y las filas de sus tablas, siempre en
+# orden de fila, lo que permite el modo constant_memory de xlsxwriter.
+
+# al escribir a una ruta, xlsxwriter vuelca cada fila a disco en lugar de
+# retener la hoja en memoria (los buffers usan in_memory, que lo excluye)
+XLSX_CONSTANT_MEMORY = os.environ.get("XLSX_CONSTANT_MEMORY", "1") == "1"
+
+# versión del contenido/formato de la indicación (XLSX y PDF); súbela al
+# cambiar lo que se imprime: invalida los PDFs guardados en render_cache
+LAYOUT_VERSION = 4
+
+class XlsxLayoutPlan:
+    __slots__ = ("formats", "columns", "title", "header", "header_row", "tables", "table_cols")
+
+    def __init__(self, header_map=HEADER_MAP, table_order=TABLE_ORDER, table_cols=TABLE_COLS):
+        self.formats = {
+            "title": {"bold": True, "font_size": 14},
+            "k": {"bold": True},
+            "v": {},
+            "tbl": {"border": 1},
+            "tbl_h": {"border": 1, "bold": True, "bg_color": "#F5F5F5"},
+        }
+        self.columns = ((0, 0, 38), (1, 1, 22), (2, 5, 16), (6, 6, 20), (7, 7, 34))
+        self.title = "INDICACIONES MÉDICAS"
+        self.header = tuple(header_map)
+        self.header_row = 3
+        self.tables = tuple(table_order)
+        self.table_cols = tuple(table_cols)
+
+    def workbook_options(self, to_buffer: bool, constant_memory: bool = XLSX_CONSTANT_MEMORY) -> dict:
+        if to_buffer:
+            # buffer en memoria (BytesIO): sin archivos temporales de xlsxwriter
+            return {"in_memory": True}
+        return {"constant_memory": constant_memory}
+
+    def write(self, wb, patient: dict, tables_rows):
+        """Escribe la hoja completa; `tables_rows` trae las filas de cada tabla de `tables`, en orden."""
+        ws = wb.add_worksheet("Indicaciones")
+        f = {name: wb.add_format(props) for name, props in self.formats.items()}
+        for first, last, width in self.columns:
+            ws.set_column(first, last, width)
+
+        ws.write_string(0, 0, self.title, f["title"])
+
+        row = self.header_row
+        for label, key in self.header:
+            ws.write_string(row, 0, label, f["k"])
+            ws.write(row, 1, "" if patient.get(key) is None else patient.get(key), f["v"])
+            row += 1
+        row += 1
+
+        for (title, _), rows in zip(self.tables, tables_rows):
+            ws.write_string(row, 0, title, f["k"])
+            ws.write_row(row + 1, 0, self.table_cols, f["tbl_h"])
+            row += 2
+            for values in rows:
+                ws.write_row(row, 0, values, f["tbl"])
+                row += 1
+            row += 1
+        return ws
+
+_XLSX_PLAN = XlsxLayoutPlan()
 
 def generate_indication_xlsx(
     plantilla_path: Path,
     output_path: Path,
     patient: dict,
-    df_catalog: pd.DataFrame,
+    df_catalog: Catalog | pd.DataFrame,
     selections: dict,
+    constant_memory: bool = XLSX_CONSTANT_MEMORY,
+    doses: dict | None = None,
 ):
     """
     Crea un XLSX con formato limpio, inspirado en tu plantilla,
-    listo para impresión/convertir a PDF.
+    listo para impresión/convertir a PDF. `output_path` puede ser una
+    ruta o un buffer escribible. `doses` (ver `prescription_doses`) se
+    calcula aquí si no viene precalculado (p. ej. por lote).
     """
-    wb = xlsxwriter.Workbook(str(output_path))
-    ws = wb.add_worksheet("Indicaciones")
+    import xlsxwriter
 
-    fmt_title = wb.add_format({"bold": True, "font_size": 14})
-    fmt_h = wb.add_format({"bold": True, "bg_color":"#EFEFEF", "border":1})
-    fmt_k = wb.add_format({"bold": True})
-    fmt_v = wb.add_format({})
-    fmt_tbl = wb.add_format({"border":1})
-    fmt_tbl_h = wb.add_format({"border":1, "bold": True, "bg_color":"#F5F5F5"})
+    catalog = _as_catalog(df_catalog)
+    if doses is None:
+        doses = prescription_doses(catalog, patient, selections)
+    to_buffer = hasattr(output_path, "write")
+    wb = xlsxwriter.Workbook(
+        output_path if to_buffer else str(output_path),
+        _XLSX_PLAN.workbook_options(to_buffer, constant_memory),
+    )
+    _XLSX_PLAN.write(
+        wb, patient,
+        (_selected_rows(catalog, selections, bucket, doses) for _, bucket in _XLSX_PLAN.tables),
+    )
+    wb.close()
 
-    ws.write("A1", "INDICACIONES MÉDICAS", fmt_title)
 
-    row = 3
-    for label, key in HEADER_MAP:
-        ws.write(row, 0, label, fmt_k)
-        ws.write(row, 1, "" if patient.get(key) is None else patient.get(key), fmt_v)
-        row += 1
+# -------------- Generación directa de PDF (sin XLSX ni LibreOffice) --------------
 
-    row += 1
-
-    def write_table(title, bucket, start_row):
-        ws.write(start_row, 0, title, fmt_k)
-        start_row += 1
-        # encabezados
-        for j, col in enumerate(TABLE_COLS):
-            ws.write(start_row, j, col, fmt_tbl_h)
-        start_row += 1
-
-        meds = selections.get(bucket.lower(), []) if isinstance(selections, dict) else []
-        # si selections es dict con claves 'premedicacion','anticuerpos','quimioterapia','otros':
-        if bucket == "Premedicación":
-            meds = selections.get("premedicacion", [])
-        elif bucket == "Anticuerpos":
-            meds = selections.get("anticuerpos", [])
-        elif bucket == "Quimioterapia":
-            meds = selections.get("quimioterapia", [])
-        elif bucket == "Otros":
-            meds = selections.get("otros", [])
-
-        cat = df_catalog[df_catalog["bucket"]==bucket]
-        for med in meds:
-            row_df = cat[cat["Medicamento"].astype(str)==str(med)].head(1)
-            if row_df.empty:
-                continue
-            r = row_df.iloc[0]
-            ws.write(start_row, 0, med, fmt_tbl)
-            ws.write(start_row, 1, r.get("Dosis",""), fmt_tbl)
-            ws.write(start_row, 2, r.get("Solución",""), fmt_tbl)
-            ws.write(start_row, 3, r.get("VS",""), fmt_tbl)
-            ws.write(start_row, 4, r.get("Tiempo",""), fmt_tbl)
-            ws.write(start_row, 5, r.get("Via",""), fmt_tbl)
-            start_row += 1
-        return start_row + 1
-
-    # Ajustes de ancho
-    ws.set_column(0, 0, 38)
-    ws.set_column(1, 1, 22)
-    ws.set_column(2, 5, 16)
-
-    for title, bucket in TABLE_ORDER:
-        row = write_table(title, bucket, row)
+DEJAVU_DIR = Path("/usr/share/fonts/truetype/dejavu")
+# anchos relativos de columna, los mismos que usa el XLSX
+_PDF_COL_WIDTHS = (38, 22, 16, 16, 16, 16, 20, 34)
 
-    wb.close()
+def _cell_text(v) -> str:
+    v = _blank_nan(v)
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+_PDF_FONT_STYLES = {"": "DejaVuSans.ttf", "B": "DejaVuSans-Bold.ttf"}
+
+# Las fuentes no se pueden compartir entre documentos (fpdf2 recorta el TTF
+# en sitio al escribir) y parsear DejaVu completa (~6000 glifos) cuesta
+# ~30 ms por estilo en cada documento. Se usa una copia reducida a estos
+# bloques (latín, griego, puntuación, símbolos, flechas, operadores
+# matemáticos y formas), ~1500 glifos, que se parsea en ~8 ms. Un documento
+# con algún carácter fuera de ellos usa la fuente completa.
+#
+# Las copias se generan una sola vez por máquina en PDF_FONT_DIR (privado
+# del usuario, nombre con la huella de la fuente de origen y de los bloques)
+# y no se borran al salir: cualquier proceso (app, lote, benchmarks) las
+# reutiliza y ninguno puede quedarse leyendo un archivo ya eliminado.
+PDF_FONT_DIR = os.environ.get("PDF_FONT_DIR") or user_cache_dir("quimio_fonts")
+_PDF_FONT_RANGES = ((0x20, 0x24F), (0x370, 0x3FF), (0x2000, 0x22FF), (0x25A0, 0x25FF))
+_PDF_UNCOVERED = re.compile(
+    r"[^\t\n\r" + "".join(rf"\u{a:04x}-\u{b:04x}" for a, b in _PDF_FONT_RANGES) + "]"
+)
+
+_PDF_FONT_FILES: dict[str, str] | None = None
+_PDF_FONT_LOCK = threading.Lock()
+
+def _subset_font(src: Path, dest: Path):
+    from fontTools import subset
+
+    options = subset.Options(notdef_outline=True, recommended_glyphs=True, glyph_names=True)
+    # tablas que fpdf2 descarta de todos modos al incrustar
+    options.drop_tables += ["FFTM", "GDEF", "GPOS", "GSUB"]
+    font = subset.load_font(str(src), options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=[c for a, b in _PDF_FONT_RANGES for c in range(a, b + 1)])
+    subsetter.subset(font)
+    # escritura atómica: otro proceso puede estar generando la misma copia
+    fd, tmp = tempfile.mkstemp(dir=dest.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            subset.save_font(font, fh, options)
+        os.replace(tmp, dest)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+def _build_pdf_fonts() -> dict[str, str]:
+    src = {style: DEJAVU_DIR / name for style, name in _PDF_FONT_STYLES.items()}
+    if not all(path.exists() for path in src.values()):
+        return {}
+    try:
+        root = private_dir(Path(PDF_FONT_DIR))
+        out = {}
+        for style, path in src.items():
+            st = path.stat()
+            tag = hashlib.sha256(repr((path.name, st.st_size, st.st_mtime_ns, _PDF_FONT_RANGES)).encode()).hexdigest()[:16]
+            dest = root / f"{path.stem}-{tag}.ttf"
+            if not dest.exists():
+                _subset_font(path, dest)
+            out[style] = str(dest)
+        return out
+    except OSError:
+        # directorio inutilizable (de otro usuario, sin permisos): fuentes completas
+        return {}
 
+def pdf_font_files() -> dict[str, str]:
+    """Fuentes reducidas (estilo -> ruta), generadas una vez por máquina; {} sin DejaVu."""
+    global _PDF_FONT_FILES
+    with _PDF_FONT_LOCK:
+        if _PDF_FONT_FILES is None:
+            _PDF_FONT_FILES = _build_pdf_fonts()
+        return _PDF_FONT_FILES
+
+def _pdf_fonts(pdf: FPDF, full: bool = False) -> str:
+    files = {} if full else pdf_font_files()
+    if not files:
+        files = {style: DEJAVU_DIR / name for style, name in _PDF_FONT_STYLES.items()}
+        if not all(path.exists() for path in files.values()):
+            # sin DejaVu instalada: fuente base (latin-1 cubre acentos y "²")
+            return "Helvetica"
+    for style, path in files.items():
+        pdf.add_font("DejaVu", style, str(path))
+    return "DejaVu"
+
+def _new_pdf(full: bool = False) -> tuple[FPDF, str]:
+    from fpdf import FPDF
+
+    pdf = FPDF(orientation="P", unit="mm", format="A4")
+    pdf.set_auto_page_break(auto=True, margin=12)
+    pdf.set_margins(12, 12, 12)
+    return pdf, _pdf_fonts(pdf, full)
+
+# Aun reducida, la fuente se parsea por documento: se deja un documento
+# vacío ya preparado para la próxima solicitud. Lo repone un único hilo de
+# fondo (se despierta tras cada render) que se detiene y espera al salir.
+_PDF_SPARE: queue.Queue = queue.Queue(maxsize=1)
+_PDF_REFILL = threading.Event()
+_PDF_REFILL_LOCK = threading.Lock()
+_PDF_REFILL_THREAD: threading.Thread | None = None
+_PDF_REFILL_STOP = False
+
+def _refill_pdf_spare():
+    if not _PDF_SPARE.full():
+        try:
+            _PDF_SPARE.put_nowait(_new_pdf())
+        except queue.Full:
+            pass
+
+def _pdf_refill_loop():
+    while True:
+        _PDF_REFILL.wait()
+        _PDF_REFILL.clear()
+        if _PDF_REFILL_STOP:
+            return
+        _refill_pdf_spare()
+
+def _stop_pdf_refill():
+    global _PDF_REFILL_STOP
+    _PDF_REFILL_STOP = True
+    _PDF_REFILL.set()
+    if _PDF_REFILL_THREAD is not None:
+        _PDF_REFILL_THREAD.join(timeout=5)
+
+def _request_pdf_spare():
+    """Pide al hilo de reposición otro documento de reserva (lo arranca la primera vez)."""
+    global _PDF_REFILL_THREAD
+    with _PDF_REFILL_LOCK:
+        if _PDF_REFILL_STOP:
+            return
+        if _PDF_REFILL_THREAD is None:
+            _PDF_REFILL_THREAD = threading.Thread(target=_pdf_refill_loop, daemon=True, name="pdf-spare")
+            _PDF_REFILL_THREAD.start()
+            atexit.register(_stop_pdf_refill)
+    _PDF_REFILL.set()
+
+def _take_pdf(full: bool = False) -> tuple[FPDF, str]:
+    if full:
+        return _new_pdf(full=True)
+    try:
+        return _PDF_SPARE.get_nowait()
+    except queue.Empty:
+        return _new_pdf()
+
+def generate_indication_pdf(
+    output_path,
+    patient: dict,
+    df_catalog: Catalog | pd.DataFrame,
+    selections: dict,
+    doses: dict | None = None,
+):
+    """
+    Genera el PDF de la indicación directamente, con el mismo contenido
+    que el XLSX (encabezado HEADER_MAP + tablas TABLE_ORDER), sin pasar
+    por LibreOffice. `output_path` puede ser una ruta o un buffer escribible.
+    """
+    from fpdf.fonts import FontFace
+
+    catalog = _as_catalog(df_catalog)
+    if doses is None:
+        doses = prescription_doses(catalog, patient, selections)
+    header = [(label, _cell_text(patient.get(key))) for label, key in HEADER_MAP]
+    tables = [
+        (title, [[_cell_text(v) for v in values] for values in _selected_rows(catalog, selections, bucket, doses)])
+        for title, bucket in TABLE_ORDER
+    ]
+    texts = [v for _, v in header] + [v for _, rows in tables for row in rows for v in row]
+    pdf, font = _take_pdf(full=any(_PDF_UNCOVERED.search(v) for v in texts))
+    pdf.add_page()
+
+    pdf.set_font(font, "B", 14)
+    pdf.cell(0, 8, "INDICACIONES MÉDICAS", new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(4)
+
+    for label, value in header:
+        pdf.set_font(font, "B", 9)
+        pdf.cell(45, 5, label)
+        pdf.set_font(font, "", 9)
+        pdf.cell(0, 5, value, new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(4)
+
+    for title, rows in tables:
+        pdf.set_font(font, "B", 9)
+        pdf.cell(0, 6, title, new_x="LMARGIN", new_y="NEXT")
+        pdf.set_font(font, "", 8)
+        with pdf.table(
+            col_widths=_PDF_COL_WIDTHS,
+            headings_style=FontFace(family=font, emphasis="BOLD", fill_color=(245, 245, 245)),
+            line_height=4.5,
+            text_align="LEFT",
+        ) as table:
+            table.row(TABLE_COLS)
+            for values in rows:
+                table.row(values)
+        pdf.ln(4)
+
+    if hasattr(output_path, "write"):
+        output_path.write(pdf.output())
+    else:
+        pdf.output(str(output_path))
+    # se repone después de escribir para no competir con este documento
+    _request_pdf_spare()
+
+# -------------- PDF de una indicación (cualquier motor) --------------
+
+ENGINE_PDF = "pdf"     # maquetación directa con fpdf2
+ENGINE_XLSX = "xlsx"   # XLSX + conversión con LibreOffice
+
+def layout_prescription(
+    patient: dict,
+    df_catalog: Catalog | pd.DataFrame,
+    selections: dict,
+    engine: str = ENGINE_PDF,
+    doses: dict | None = None,
+) -> bytes:
+    """
+    Maqueta la indicación en memoria: los bytes del PDF con el motor PDF, o
+    los del XLSX (aún sin convertir) con el motor XLSX.
+    """
+    buf = io.BytesIO()
+    if engine == ENGINE_XLSX:
+        with metrics.span("layout_xlsx"):
+            generate_indication_xlsx(
+                plantilla_path=None,
+                output_path=buf,
+                patient=patient,
+                df_catalog=df_catalog,
+                selections=selections,
+                doses=doses,
+            )
+    else:
+        with metrics.span("layout_pdf"):
+            generate_indication_pdf(buf, patient, df_catalog, selections, doses)
+    return buf.getvalue()
+
+def render_prescription_pdf(
+    patient: dict,
+    df_catalog: Catalog | pd.DataFrame,
+    selections: dict,
+    engine: str = ENGINE_PDF,
+    doses: dict | None = None,
+) -> bytes:
+    """Genera la indicación con el motor elegido y devuelve los bytes del PDF."""
+    doc = layout_prescription(patient, df_catalog, selections, engine, doses)
+    if engine == ENGINE_XLSX:
+        # el único paso que necesita disco: LibreOffice lee y escribe archivos
+        return convert_xlsx_bytes(doc)
+    return doc
+
+# -------------- Precarga --------------
+
+def preload():
+    """
+    Importa las dependencias pesadas que usa una solicitud (pandas no: solo
+    sirve para exportar el catálogo) y deja listo el documento PDF de
+    reserva. Pensado para un hilo en segundo plano tras el arranque, así la
+    primera solicitud no paga las importaciones diferidas.
+    """
+    import bsa, dose_engine, openpyxl, xlsxwriter  # noqa: F401
+    _refill_pdf_spare()
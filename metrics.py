@@ -0,0 +1,186 @@
+"""
+Instrumentación mínima, sin dependencias: contadores, histogramas de
+latencia y tramos (`span`) por etapa, expuestos en formato de texto de
+Prometheus.
+
+    with metrics.span("catalog_parse"):
+        ...
+
+`serve(port)` levanta un servidor HTTP en segundo plano con /metrics.
+`collect(spans, fn, ...)` ejecuta `fn` anotando en `spans` los tramos de
+esa solicitud (para el JSON de depuración).
+"""
+from __future__ import annotations
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import contextlib
+import contextvars
+import logging
+import os
+import threading
+import time
+
+# 9100 es el de node_exporter y 7860+ los de Gradio; 0 = sin endpoint
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9778"))
+
+log = logging.getLogger(__name__)
+
+# segundos; cubre desde un render directo (~ms) hasta LibreOffice en frío
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_LOCK = threading.Lock()
+_METRICS: list = []
+
+
+def _labels_text(names, values, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: dict[tuple, float] = {}
+        _METRICS.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with _LOCK:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels.get(n, "")) for n in self.labels), 0)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, v in sorted(self._values.items()):
+            out.append(f"{self.name}{_labels_text(self.labels, key)} {_fmt(v)}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(buckets)
+        # por serie: [conteo por bucket..., suma, total]
+        self._series: dict[tuple, list[float]] = {}
+        _METRICS.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with _LOCK:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, s in sorted(self._series.items()):
+            for le, n in zip(self.buckets, s):
+                le_label = 'le="%s"' % le
+                out.append(f"{self.name}_bucket{_labels_text(self.labels, key, le_label)} {n}")
+            inf_label = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_labels_text(self.labels, key, inf_label)} {s[-1]}")
+            out.append(f"{self.name}_sum{_labels_text(self.labels, key)} {s[-2]!r}")
+            out.append(f"{self.name}_count{_labels_text(self.labels, key)} {s[-1]}")
+        return out
+
+
+# -------------- Métricas de la aplicación --------------
+
+STAGE_SECONDS = Histogram("quimio_stage_seconds", "Duración de cada etapa de la generación.", ("stage",))
+REQUEST_SECONDS = Histogram("quimio_request_seconds", "Duración total de una solicitud de la interfaz.", ("kind", "engine"))
+REQUESTS = Counter("quimio_requests_total", "Solicitudes de la interfaz por resultado.", ("kind", "engine", "result"))
+CATALOG_CACHE = Counter("quimio_catalog_cache_total", "Búsquedas en la caché de catálogos (hit/miss).", ("result",))
+RENDER_CACHE = Counter("quimio_render_cache_total", "Búsquedas en la caché de PDFs generados (hit/miss).", ("result",))
+CONVERSIONS = Counter("quimio_conversions_total", "Archivos convertidos por LibreOffice, por resultado.", ("result",))
+
+
+# -------------- Tramos --------------
+
+_TRACE: contextvars.ContextVar[list | None] = contextvars.ContextVar("quimio_trace", default=None)
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Mide el bloque en STAGE_SECONDS y, si hay una solicitud en curso, lo anota en su traza."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        STAGE_SECONDS.observe(dt, stage=stage)
+        trace = _TRACE.get()
+        if trace is not None:
+            trace.append((stage, dt))
+
+
+def collect(spans: list, fn, *args, **kwargs):
+    """Ejecuta `fn` anotando en `spans` los tramos (etapa, segundos) que ocurran dentro, en este hilo."""
+    token = _TRACE.set(spans)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _TRACE.reset(token)
+
+
+def summarize(spans) -> dict[str, float]:
+    """Segundos por etapa (sumando repeticiones), redondeados para mostrar."""
+    out: dict[str, float] = {}
+    for stage, dt in spans:
+        out[stage] = out.get(stage, 0.0) + dt
+    return {k: round(v, 4) for k, v in out.items()}
+
+
+# -------------- Exposición --------------
+
+def render() -> str:
+    with _LOCK:
+        lines = [line for m in _METRICS for line in m.render()]
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port: int = METRICS_PORT, host: str = "0.0.0.0") -> ThreadingHTTPServer | None:
+    """
+    Sirve /metrics en un hilo de fondo; devuelve el servidor, o None si
+    `port` es 0 o no se pudo abrir (las métricas nunca detienen la app).
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        log.warning("Endpoint de métricas desactivado (puerto %s): %s", port, e)
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    return server
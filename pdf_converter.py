@@ -0,0 +1,309 @@
+from __future__ import annotations
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+import atexit
+import itertools
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import metrics
+
+# -------------- Pool de LibreOffice --------------
+#
+# Cada worker mantiene un soffice headless vivo con su propio perfil
+# (-env:UserInstallation). Al lanzar `soffice --convert-to` con el mismo
+# perfil, LibreOffice entrega la orden a la instancia ya caliente por su
+# tubería IPC en lugar de arrancar la suite completa.
+
+SOFFICE_BIN = os.environ.get("SOFFICE_BIN") or shutil.which("soffice") or shutil.which("libreoffice") or "libreoffice"
+POOL_SIZE = int(os.environ.get("LIBREOFFICE_POOL_SIZE", "2"))
+CONVERT_TIMEOUT = float(os.environ.get("LIBREOFFICE_TIMEOUT", "60"))
+# ventana (s) en la que se agrupan solicitudes en una sola invocación; 0 = sin agrupar
+BATCH_WINDOW = float(os.environ.get("LIBREOFFICE_BATCH_WINDOW", "0.05"))
+BATCH_MAX = int(os.environ.get("LIBREOFFICE_BATCH_MAX", "25"))
+STARTUP_TIMEOUT = 30.0
+
+
+class ConversionError(RuntimeError):
+    pass
+
+
+class _SofficeWorker:
+    def __init__(self, idx: int, base_dir: Path):
+        self.idx = idx
+        self.profile = base_dir / f"perfil_{idx}"
+        self.proc: subprocess.Popen | None = None
+
+    @property
+    def _profile_arg(self) -> str:
+        return f"-env:UserInstallation={self.profile.as_uri()}"
+
+    def start(self):
+        self.profile.mkdir(parents=True, exist_ok=True)
+        self.proc = subprocess.Popen(
+            [SOFFICE_BIN, self._profile_arg, "--headless", "--invisible",
+             "--norestore", "--nologo", "--nodefault", "--nolockcheck"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        # espera a que el perfil quede inicializado (primer arranque)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline and self.alive():
+            if (self.profile / "user").exists():
+                break
+            time.sleep(0.1)
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def convert(self, xlsx_path: Path, outdir: Path) -> Path:
+        pdf = self.convert_many([xlsx_path], outdir)[0]
+        if isinstance(pdf, Exception):
+            raise pdf
+        return pdf
+
+    def convert_many(self, xlsx_paths: list[Path], outdir: Path) -> list[Path | ConversionError]:
+        """Convierte varios XLSX en una sola invocación; un error por archivo sin PDF."""
+        with metrics.span("libreoffice"):
+            subprocess.run(
+                [SOFFICE_BIN, self._profile_arg, "--headless", "--convert-to", "pdf",
+                 "--outdir", str(outdir), *map(str, xlsx_paths)],
+                check=True, timeout=CONVERT_TIMEOUT * len(xlsx_paths),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            )
+        out = []
+        for x in xlsx_paths:
+            pdf = outdir / (Path(x).stem + ".pdf")
+            out.append(pdf if pdf.exists() else ConversionError(f"LibreOffice no produjo {pdf.name}"))
+        return out
+
+
+class LibreOfficePool:
+    """
+    Pool de tamaño fijo de instancias soffice headless.
+    Las solicitudes esperan en una cola hasta que hay un worker libre;
+    antes de cada conversión se verifica que el proceso siga vivo y,
+    si falló o se colgó, se reinicia.
+    """
+
+    def __init__(self, size: int = POOL_SIZE):
+        self.size = max(1, size)
+        self._base = Path(tempfile.mkdtemp(prefix="soffice_pool_"))
+        self._idle: queue.Queue[_SofficeWorker] = queue.Queue()
+        self._workers: list[_SofficeWorker] = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._closed = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for i in range(self.size):
+                w = _SofficeWorker(i, self._base)
+                w.start()
+                self._workers.append(w)
+                self._idle.put(w)
+            self._started = True
+
+    def convert(self, xlsx_path: Path, outdir: Path | None = None) -> Path:
+        outdir = Path(outdir) if outdir is not None else Path(xlsx_path).parent
+        pdf = self.convert_many([Path(xlsx_path)], outdir)[0]
+        if isinstance(pdf, Exception):
+            raise pdf
+        return pdf
+
+    def convert_many(self, xlsx_paths: list[Path], outdir: Path) -> list[Path | ConversionError]:
+        """
+        Convierte varios XLSX (nombres distintos) a `outdir` con una sola
+        invocación de LibreOffice. Devuelve, en el mismo orden, la ruta del
+        PDF o el error de ese archivo.
+        """
+        if self._closed:
+            raise ConversionError("El pool de LibreOffice está cerrado")
+        self.start()
+        results = self._convert_many([Path(x) for x in xlsx_paths], outdir)
+        for r in results:
+            metrics.CONVERSIONS.inc(result="error" if isinstance(r, Exception) else "ok")
+        return results
+
+    def _convert_many(self, xlsx_paths: list[Path], outdir: Path) -> list[Path | ConversionError]:
+        w = self._idle.get()
+        try:
+            if not w.alive():
+                w.restart()
+            try:
+                return w.convert_many(xlsx_paths, outdir)
+            except subprocess.SubprocessError:
+                # instancia colgada o caída: reinicia y reintenta uno por uno,
+                # así un documento problemático no arrastra al resto del grupo
+                w.restart()
+                out = []
+                for x in xlsx_paths:
+                    try:
+                        out.append(w.convert(x, outdir))
+                    except subprocess.SubprocessError as e:
+                        w.restart()
+                        out.append(ConversionError(f"Falló la conversión de {x.name}: {e}"))
+                    except ConversionError as e:
+                        out.append(e)
+                return out
+        finally:
+            self._idle.put(w)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for w in self._workers:
+                w.stop()
+            self._workers.clear()
+            shutil.rmtree(self._base, ignore_errors=True)
+
+
+_POOL: LibreOfficePool | None = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> LibreOfficePool:
+    """Pool compartido del proceso (POOL_SIZE workers)."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = LibreOfficePool(POOL_SIZE)
+            atexit.register(_POOL.close)
+        return _POOL
+
+
+# -------------- Agrupación de solicitudes --------------
+
+class ConversionScheduler:
+    """
+    Junta las solicitudes que llegan dentro de una ventana corta (o hasta
+    `max_batch`) y las convierte con una sola invocación por grupo. Cada
+    archivo se enlaza en un directorio de trabajo con un nombre único, de
+    modo que solicitudes con el mismo nombre no chocan y cada PDF vuelve a
+    su solicitud (en el `outdir` pedido).
+    """
+
+    def __init__(self, pool: LibreOfficePool, window: float = BATCH_WINDOW, max_batch: int = BATCH_MAX):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self._requests: queue.Queue[tuple[Path, Path, Future]] = queue.Queue()
+        self._runner = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="soffice_batch")
+        self._seq = itertools.count()
+        self._thread = threading.Thread(target=self._collect_loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, xlsx_path: Path, outdir: Path | None = None) -> Future:
+        fut: Future = Future()
+        outdir = Path(outdir) if outdir is not None else Path(xlsx_path).parent
+        self._requests.put((Path(xlsx_path), outdir, fut))
+        return fut
+
+    def _collect_loop(self):
+        while True:
+            group = [self._requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(group) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    group.append(self._requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._runner.submit(self._run_group, group)
+
+    def _run_group(self, group):
+        workdir = Path(tempfile.mkdtemp(prefix="soffice_grupo_", dir=self.pool._base))
+        try:
+            staged = []
+            for xlsx, _, _ in group:
+                dst = workdir / f"{next(self._seq)}_{xlsx.name}"
+                try:
+                    os.link(xlsx, dst)
+                except OSError:
+                    shutil.copyfile(xlsx, dst)
+                staged.append(dst)
+            try:
+                results = self.pool.convert_many(staged, workdir)
+            except Exception as e:
+                results = [e] * len(group)
+            for (xlsx, outdir, fut), res in zip(group, results):
+                if isinstance(res, Exception):
+                    # el mensaje lleva el nombre temporal; se reporta el original
+                    fut.set_exception(ConversionError(f"No se pudo convertir {xlsx.name}: {res}"))
+                    continue
+                pdf = outdir / (xlsx.stem + ".pdf")
+                shutil.move(str(res), pdf)
+                fut.set_result(pdf)
+        except Exception as e:
+            for _, _, fut in group:
+                if not fut.done():
+                    fut.set_exception(e)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+_SCHEDULER: ConversionScheduler | None = None
+
+
+def get_scheduler() -> ConversionScheduler:
+    global _SCHEDULER
+    pool = get_pool()
+    with _POOL_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = ConversionScheduler(pool)
+        return _SCHEDULER
+
+
+def convert_to_pdf(xlsx_path: Path, outdir: Path | None = None) -> Path:
+    """
+    Convierte un XLSX a PDF usando el pool compartido de LibreOffice.
+    Con LIBREOFFICE_BATCH_WINDOW > 0, las solicitudes simultáneas se
+    agrupan en una sola invocación.
+    """
+    if BATCH_WINDOW <= 0:
+        return get_pool().convert(xlsx_path, outdir)
+    return get_scheduler().submit(xlsx_path, outdir).result()
+
+
+def convert_xlsx_bytes(xlsx: bytes, name: str = "Indicacion.xlsx") -> bytes:
+    """Convierte un XLSX en memoria; el archivo solo vive en el directorio del pool."""
+    pool = get_pool()
+    workdir = Path(tempfile.mkdtemp(prefix="soffice_xlsx_", dir=pool._base))
+    try:
+        xlsx_path = workdir / name
+        with metrics.span("file_io"):
+            xlsx_path.write_bytes(xlsx)
+        pdf = convert_to_pdf(xlsx_path, workdir)
+        with metrics.span("file_io"):
+            return pdf.read_bytes()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def convert_many(xlsx_paths: list[Path], outdir: Path) -> list[Path | ConversionError]:
+    """Convierte un grupo ya reunido (p. ej. un lote) en una sola invocación."""
+    return get_pool().convert_many(xlsx_paths, Path(outdir))
@@ -0,0 +1,57 @@
+"""
+Función renal para el cálculo de dosis.
+
+Cockcroft-Gault (mL/min), con peso en kg, edad en años y creatinina sérica
+en mg/dL:
+
+    CrCl = (140 - edad) x peso / (72 x Cr)   (x 0.85 en mujeres)
+
+La TFG para Calvert (carboplatino: mg = AUC x (TFG + 25)) es la CrCl con
+tope CALVERT_GFR_CAP (125 mL/min por defecto, como recomiendan las guías).
+Igual que en bsa.py, todo acepta escalares o arreglos de NumPy; un dato
+faltante o fuera de rango da NaN.
+"""
+from __future__ import annotations
+import math
+import os
+
+import numpy as np
+
+CALVERT_GFR_CAP = float(os.environ.get("CALVERT_GFR_CAP", "125"))
+
+
+def female_flag(sexo) -> float:
+    """1.0 mujer, 0.0 hombre, NaN si no se reconoce ("FEM"/"MAS" en la interfaz)."""
+    s = str(sexo or "").strip().lower()
+    if s.startswith("f") or s == "mujer":
+        return 1.0
+    if s.startswith("mas") or s in ("h", "hombre", "varon", "varón"):
+        return 0.0
+    return math.nan
+
+
+def cockcroft_gault(edad, peso, cr, female) -> np.ndarray:
+    """CrCl (mL/min) vectorizada; `female` es 1.0/0.0/NaN por paciente (ver `female_flag`)."""
+    edad = np.asarray(edad, dtype=np.float64)
+    peso = np.asarray(peso, dtype=np.float64)
+    cr = np.asarray(cr, dtype=np.float64)
+    female = np.asarray(female, dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        valid = (edad > 0) & (edad < 140) & (peso > 0) & (cr > 0) & ~np.isnan(female)
+        crcl = (140.0 - edad) * peso / (72.0 * cr) * np.where(female == 1.0, 0.85, 1.0)
+    return np.where(valid, crcl, np.nan)
+
+
+def calvert_gfr(crcl, cap: float | None = CALVERT_GFR_CAP) -> np.ndarray:
+    """TFG para Calvert: la CrCl con tope (NaN se conserva)."""
+    crcl = np.asarray(crcl, dtype=np.float64)
+    if not cap:
+        return crcl
+    # np.fmin sola convertiría un dato faltante (NaN) en el tope
+    return np.where(np.isnan(crcl), np.nan, np.fmin(crcl, cap))
+
+
+def calvert_dose(auc, gfr) -> np.ndarray:
+    """Carboplatino (mg) = AUC x (TFG + 25)."""
+    return np.asarray(auc, dtype=np.float64) * (np.asarray(gfr, dtype=np.float64) + 25.0)
+
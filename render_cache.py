@@ -0,0 +1,155 @@
+from __future__ import annotations
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+
+import metrics
+from generate_prescription import LAYOUT_VERSION, Catalog, private_dir, user_cache_dir
+
+# -------------- Caché de PDFs generados --------------
+#
+# Reimpresiones, la copia para farmacia o recargar la página piden la misma
+# indicación otra vez. Cada PDF se guarda en disco bajo el SHA-256 de su
+# contenido lógico: paciente y selecciones normalizados, huella del catálogo,
+# versión del formato (LAYOUT_VERSION), configuración que cambia las dosis
+# (p. ej. CALVERT_GFR_CAP) y motor. Un acierto devuelve el PDF
+# sin maquetar ni convertir. El directorio tiene un presupuesto de tamaño y
+# se desalojan los menos usados (LRU).
+#
+# Los PDFs llevan datos de pacientes: el directorio se crea con modo 0700
+# (por defecto uno por usuario), se rechaza si pertenece a otro usuario y
+# cada PDF se escribe con modo 0600. RENDER_CACHE_MB=0 desactiva la caché.
+
+log = logging.getLogger(__name__)
+
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR") or user_cache_dir("quimio_pdf_cache")
+RENDER_CACHE_MB = float(os.environ.get("RENDER_CACHE_MB", "256"))
+
+
+def _normalize(v):
+    # mismos valores impresos -> misma clave (60 y 60.0, "Ana " y "Ana", None y "")
+    if isinstance(v, dict):
+        return {str(k): _normalize(x) for k, x in sorted(v.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(v, (list, tuple)):
+        return [_normalize(x) for x in v]
+    if isinstance(v, float):
+        if math.isnan(v):
+            return None
+        return int(v) if v.is_integer() else v
+    if isinstance(v, str):
+        return v.strip() or None
+    return v
+
+
+def prescription_key(patient: dict, catalog: Catalog, selections: dict, engine: str) -> str | None:
+    """Clave de la indicación, o None si el catálogo no tiene huella (no se puede cachear)."""
+    if catalog.digest is None:
+        return None
+    from dose_engine import dose_settings
+
+    payload = json.dumps(
+        [_normalize(patient), _normalize(selections), catalog.digest, LAYOUT_VERSION, dose_settings(), engine],
+        ensure_ascii=False, sort_keys=True, default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """PDFs en `root` (<clave>.pdf) con un presupuesto total de `budget_bytes` y desalojo LRU."""
+
+    def __init__(self, root=RENDER_CACHE_DIR, budget_bytes: int = int(RENDER_CACHE_MB * 1024 * 1024)):
+        self.root = private_dir(Path(root))
+        self.budget = budget_bytes
+        self._lock = threading.Lock()
+        self._index: OrderedDict[str, int] = OrderedDict()  # clave -> bytes, del menos al más reciente
+        self._size = 0
+        # lo que quedó de ejecuciones anteriores, en orden de último uso
+        files = []
+        for p in self.root.glob("*.pdf"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, p.stem, st.st_size))
+        for _, key, size in sorted(files):
+            self._index[key] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.pdf"
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            if key not in self._index:
+                metrics.RENDER_CACHE.inc(result="miss")
+                return None
+            self._index.move_to_end(key)
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # el mtime hace de "último uso" al reiniciar
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._index.pop(key, 0)
+            metrics.RENDER_CACHE.inc(result="miss")
+            return None
+        metrics.RENDER_CACHE.inc(result="hit")
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.budget:
+            return
+        path = self._path(key)
+        tmp = path.with_name(f"{key}.{threading.get_ident()}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        tmp.replace(path)
+        with self._lock:
+            self._size += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.budget and self._index:
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+
+_CACHE: RenderCache | None = None
+_CACHE_DISABLED = False
+_CACHE_LOCK = threading.Lock()
+
+
+def get_render_cache() -> RenderCache | None:
+    """Caché compartida del proceso; None si RENDER_CACHE_MB es 0 o el directorio no es seguro."""
+    global _CACHE, _CACHE_DISABLED
+    if RENDER_CACHE_MB <= 0:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None and not _CACHE_DISABLED:
+            try:
+                _CACHE = RenderCache()
+            except OSError as e:
+                # sin caché se sigue generando; nunca en un directorio ajeno
+                log.warning("Caché de PDFs desactivada: %s", e)
+                _CACHE_DISABLED = True
+        return _CACHE
@@ -0,0 +1,150 @@
+from __future__ import annotations
+from datetime import datetime
+from pathlib import Path
+import contextlib
+import os
+import sqlite3
+import threading
+
+import catalog_snapshot
+from generate_prescription import (
+    Catalog,
+    extract_catalog,
+    load_compiled_template,
+    _template_buffer,
+)
+
+# -------------- Registro local de plantillas --------------
+#
+# Directorio con una copia de cada versión de plantilla (<sha256>.xlsx), su
+# catálogo compilado (<sha256>.pqcat) y un índice SQLite de versiones por
+# nombre. Una plantilla registrada a partir de un snapshot (.pqcat) solo
+# guarda el snapshot, bajo el SHA-256 del XLSX del que se compiló. Los catálogos registrados se mantienen cargados en memoria, así la
+# interfaz no necesita volver a subir ni parsear el libro.
+
+TEMPLATES_DIR = os.environ.get("TEMPLATES_DIR", "plantillas")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plantillas (
+    nombre     TEXT    NOT NULL,
+    version    INTEGER NOT NULL,
+    sha256     TEXT    NOT NULL,
+    creada     TEXT    NOT NULL,
+    n_items    INTEGER NOT NULL,
+    PRIMARY KEY (nombre, version)
+)
+"""
+
+
+class TemplateRegistry:
+    def __init__(self, root=TEMPLATES_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._db = self.root / "index.sqlite"
+        self._catalogs: dict[str, Catalog] = {}
+        self._lock = threading.Lock()
+        with self._connect() as con:
+            con.execute(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        con = sqlite3.connect(self._db)
+        try:
+            with con:  # commit / rollback
+                yield con
+        finally:
+            con.close()
+
+    def register(self, nombre: str, src) -> tuple[str, int]:
+        """
+        Registra una plantilla bajo `nombre`. Si su contenido es igual al de
+        la última versión no se crea una nueva. Devuelve (nombre, versión).
+        """
+        nombre = nombre.strip()
+        if not nombre:
+            raise ValueError("La plantilla necesita un nombre.")
+        # se parsea antes de escribir nada: un archivo ilegible no deja copias
+        try:
+            catalog = extract_catalog(src)
+        except ValueError:
+            raise
+        except Exception as e:  # ZIP dañado, sin hoja Listas...
+            raise ValueError(f"Plantilla ilegible: {type(e).__name__}: {e}") from e
+        digest = catalog.digest
+
+        with _template_buffer(src) as data, self._lock, self._connect() as con:
+            last = con.execute(
+                "SELECT version, sha256 FROM plantillas WHERE nombre = ? ORDER BY version DESC LIMIT 1",
+                (nombre,),
+            ).fetchone()
+            if last is not None and last[1] == digest:
+                return nombre, last[0]
+            if catalog_snapshot.is_snapshot(data):
+                self._store(f"{digest}.pqcat", data)
+            else:
+                self._store(f"{digest}.xlsx", data)
+                load_compiled_template(self.root / f"{digest}.xlsx", self.root / f"{digest}.pqcat")
+            version = 1 if last is None else last[0] + 1
+            con.execute(
+                "INSERT INTO plantillas (nombre, version, sha256, creada, n_items) VALUES (?, ?, ?, ?, ?)",
+                (nombre, version, digest, datetime.now().isoformat(timespec="seconds"), len(catalog)),
+            )
+            self._catalogs[digest] = catalog
+        return nombre, version
+
+    def _store(self, name: str, data):
+        path = self.root / name
+        if not path.exists():
+            tmp = path.with_suffix(".tmp")
+            tmp.write_bytes(data)
+            tmp.replace(path)
+
+    def versions(self) -> list[dict]:
+        """Todas las versiones registradas, por nombre y de la más nueva a la más vieja."""
+        with self._connect() as con:
+            rows = con.execute(
+                "SELECT nombre, version, sha256, creada, n_items FROM plantillas ORDER BY nombre, version DESC"
+            ).fetchall()
+        return [dict(zip(("nombre", "version", "sha256", "creada", "n_items"), r)) for r in rows]
+
+    def _digest(self, nombre: str, version: int | None) -> str:
+        with self._connect() as con:
+            if version is None:
+                row = con.execute(
+                    "SELECT sha256 FROM plantillas WHERE nombre = ? ORDER BY version DESC LIMIT 1", (nombre,)
+                ).fetchone()
+            else:
+                row = con.execute(
+                    "SELECT sha256 FROM plantillas WHERE nombre = ? AND version = ?", (nombre, version)
+                ).fetchone()
+        if row is None:
+            raise KeyError(f"Plantilla no registrada: {nombre} v{version or 'última'}")
+        return row[0]
+
+    def catalog(self, nombre: str, version: int | None = None) -> Catalog:
+        """Catálogo de una versión registrada (la última si no se indica), desde memoria."""
+        digest = self._digest(nombre, version)
+        with self._lock:
+            cat = self._catalogs.get(digest)
+        if cat is None:
+            xlsx, pqcat = self.root / f"{digest}.xlsx", self.root / f"{digest}.pqcat"
+            # recompila el snapshot si falta o es de otro formato; sin XLSX
+            # (registrada desde un .pqcat) se usa el snapshot tal cual
+            cat = load_compiled_template(xlsx, pqcat) if xlsx.exists() else extract_catalog(pqcat)
+            with self._lock:
+                self._catalogs[digest] = cat
+        return cat
+
+    def warm(self):
+        """Carga en memoria los catálogos de todas las versiones registradas."""
+        for v in self.versions():
+            self.catalog(v["nombre"], v["version"])
+
+    # etiquetas para la interfaz: "Nombre (v3)"
+
+    def labels(self) -> list[str]:
+        return [f"{v['nombre']} (v{v['version']})" for v in self.versions()]
+
+    def catalog_for_label(self, label: str) -> Catalog:
+        nombre, _, version = label.rpartition(" (v")
+        return self.catalog(nombre, int(version.rstrip(")")))